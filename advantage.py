@@ -0,0 +1,62 @@
+"""
+
+Discounted returns and advantages over a whole batch of paths at once.
+Rewards of all paths are concatenated, lengths gives the steps of each one.
+
+Every quantity here is the backward recurrence
+
+    y[t] = x[t] + c[t] * y[t + 1]
+
+with c[t] the discount inside a path and 0 on its last step, solved by
+discount in log2(steps) numpy passes instead of a Python loop per step.
+
+"""
+
+import numpy as np
+
+
+def coefficients(lengths, gamma):
+    """
+    gamma on every step, 0 on the last step of each path
+    """
+    c = np.full(int(np.sum(lengths)), gamma, dtype=np.float64)
+    c[np.cumsum(lengths) - 1] = 0.0
+    return c
+
+def discount(x, c):
+    # doubling scan: after the pass with offset d every y[t] holds the sum
+    # over its next 2d steps, a[t] the product of their coefficients
+    y = np.array(x, dtype=np.float64)
+    a = np.array(c, dtype=np.float64)
+    d = 1
+    while d < len(y):
+        y[:-d] = y[:-d] + a[:-d] * y[d:]
+        a[:-d] = a[:-d] * a[d:]
+        d *= 2
+    return y
+
+def rewardstogo(rewards, lengths, gamma):
+    return discount(rewards, coefficients(lengths, gamma))
+
+def episodereturns(rewards, lengths, gamma):
+    """
+    Discounted return of its whole path on every step
+    """
+    q = rewardstogo(rewards, lengths, gamma)
+    starts = np.cumsum(lengths) - lengths
+    return np.repeat(q[starts], lengths)
+
+def gae(rewards, values, lengths, gamma, lam):
+    """
+    Generalized advantage estimation, values are the baseline of every step,
+    the value after the last step of a path is taken as 0
+    """
+    values = np.asarray(values, dtype=np.float64)
+    c = coefficients(lengths, gamma)
+    nextvalues = np.append(values[1:], 0.0)
+    deltas = rewards + c * nextvalues - values
+    return discount(deltas, c * lam)
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float64)
+    return (x - x.mean()) / (x.std() + 1e-8)
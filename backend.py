@@ -1,3 +1,5 @@
+import os
+import subprocess
 import tensorflow as tf
 def createFunc_helper():
     return ActorFunc()
@@ -12,20 +14,65 @@ class NNBackend:
     def runOptimizer(self):
         return;
 
+    def runBaseline(self):
+        return;
+
+    def runPush(self):
+        return;
+
 class TFBackend(NNBackend):
-    def __init__(self, name):
-        tf.set_random_seed(0)
+    """
+    act_threads and update_threads size the inter-op pools used by runAction
+    and by the update ops, intra_threads the per-op pool they share. cpus
+    pins the process to a taskset cpu list like "0-15" before the session
+    starts its threads. seed is the graph seed of the initial weights and
+    of the sampled actions.
+    """
+    def __init__(self, name, act_threads=1, update_threads=1, intra_threads=1, cpus=None, seed=0):
+        tf.set_random_seed(seed)
+        self._act_threads = act_threads
+        self._update_threads = update_threads
+        self._intra_threads = intra_threads
+        self._cpus = cpus
 
     def init(self):
-        tf_config = tf.ConfigProto(inter_op_parallelism_threads=1, intra_op_parallelism_threads=1) 
+        if self._cpus:
+            setaffinity(self._cpus)
+        tf_config = tf.ConfigProto(intra_op_parallelism_threads=self._intra_threads)
+        tf_config.session_inter_op_thread_pool.add().num_threads = self._act_threads
+        tf_config.session_inter_op_thread_pool.add().num_threads = self._update_threads
+        self._actopts = tf.RunOptions(inter_op_thread_pool=0)
+        self._updateopts = tf.RunOptions(inter_op_thread_pool=1)
         self._sess = tf.Session(config=tf_config)
         self._sess.__enter__() # equivalent to `with sess:`
         tf.global_variables_initializer().run() #pylint: disable=E1101
 
-    def runAction(self, ops, sy_ob_no, params):
-        return self._sess.run(ops, feed_dict={sy_ob_no: params})
+    def close(self):
+        self._sess.__exit__(None, None, None)
+        self._sess.close()
+
+    # the candidate mask is only fed when given, every action is a
+    # candidate otherwise
+    def runAction(self, ops, sy_ob_no, params, sy_mask_na=None, mask=None):
+        feed = {sy_ob_no: params}
+        if mask is not None:
+            feed[sy_mask_na] = mask
+        return self._sess.run(ops, feed_dict=feed, options=self._actopts)
+
+    def runOptimizer(self, updateops, sy_ob_no, sy_ac_na, sy_adv_n, ob_no, ac_na, adv_n, sy_mask_na=None, mask=None):
+        feed = {sy_ob_no: ob_no, sy_ac_na: ac_na, sy_adv_n: adv_n}
+        if mask is not None:
+            feed[sy_mask_na] = mask
+        return self._sess.run(updateops, feed_dict=feed, options=self._updateopts)
+
+    def runBaseline(self, baselineops, sy_ob_no, sy_target_n, ob_no, target_n):
+        return self._sess.run(baselineops, feed_dict={sy_ob_no: ob_no, sy_target_n: target_n}, options=self._updateopts)
+
+    def runPush(self, pushop):
+        return self._sess.run(pushop, options=self._updateopts)
 
-    def runOptimizer(self, updateops, sy_ob_no, sy_ac_na, sy_adv_n, ob_no, ac_na, adv_n):
-        return self._sess.run(updateops, feed_dict={sy_ob_no: ob_no, sy_ac_na: ac_na, sy_adv_n: adv_n})
+# every thread of the process, the ones started later inherit it
+def setaffinity(cpus):
+    subprocess.check_call(["taskset", "-a", "-p", "-c", cpus, str(os.getpid())], stdout=open(os.devnull, "w"))
 
 
@@ -0,0 +1,357 @@
+import parse
+import protocol
+import shm
+import advantage
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+import socket
+import struct
+import time
+import multiprocessing
+from multiprocessing import Process
+
+
+def genintervals(count, actionsize, maxlength):
+    cols = np.random.randint(0, actionsize, count)
+    starts = np.random.randint(0, maxlength, count)
+    ends = np.minimum(starts + np.random.randint(0, maxlength / 4 + 1, count), maxlength - 1)
+    return cols, starts, ends
+
+# every measurement of a run, written out by main with --json
+RESULTS = []
+
+
+def record(bench, variant, seconds, **params):
+    params.update({"bench": bench, "variant": variant, "seconds": seconds})
+    RESULTS.append(params)
+
+def timeit(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        begin = time.time()
+        fn()
+        best = min(best, time.time() - begin)
+    return best
+
+def bench_occupy(counts, actionsize=45, maxlength=3000, repeat=3):
+    ratio = maxlength / actionsize + 1
+    print("%10s %12s %12s %10s" % ("intervals", "loop(ms)", "numpy(ms)", "speedup"))
+    for count in counts:
+        cols, starts, ends = genintervals(count, actionsize, maxlength)
+        a = np.zeros((actionsize, actionsize))
+        b = np.zeros((actionsize, actionsize))
+        loop = timeit(lambda: parse.occupyloop(a, cols, starts, ends, ratio), repeat)
+        vec = timeit(lambda: parse.occupy(b, cols, starts, ends, ratio), repeat)
+        assert (a == b).all()
+        record("occupy", "loop", loop, intervals=count, maxlength=maxlength)
+        record("occupy", "numpy", vec, intervals=count, maxlength=maxlength)
+        print("%10d %12.3f %12.3f %9.1fx" % (count, loop * 1e3, vec * 1e3, loop / max(vec, 1e-9)))
+
+def genstate(name, count, actionsize, maxlength, registers=None):
+    """
+    Write a random state.txt of count intervals over registers names, the
+    first actionsize of them are the ones in the action set
+    """
+    cols, starts, ends = genintervals(count, registers or actionsize, maxlength)
+    regs = np.random.permutation(actionsize)
+    f = open(name, "w")
+    f.write("3333&" + str(maxlength / 3) + "&" + str(maxlength / 2) + "\n")
+    f.write("reward\n")
+    f.write("".join(str(r) + "&" + str(i) + "&" for i, r in enumerate(regs[:4])) + "\n")
+    f.write("vreward\n")
+    f.write("".join(str(r) + "&" + str(i) + "&" for i, r in enumerate(regs[4:6])) + "\n")
+    for reg, start, end in zip(cols, starts, ends):
+        f.write(str(reg) + "&" + str(start) + "&" + str(end) + "\n")
+    f.close()
+    return open(name).read()
+
+def bench_transport(counts, name="state.txt", actionsize=45, maxlength=3000, repeat=20):
+    reg2idx = parse.regtable(dict((str(i), i) for i in range(actionsize)))
+    left, right = socket.socketpair()
+    print("%10s %12s %12s %10s" % ("intervals", "text(ms)", "binary(ms)", "speedup"))
+    for count in counts:
+        text = genstate(name, count, actionsize, maxlength)
+        frame = protocol.statefromfile(name, 1)
+        def textstep():
+            # compiler writes state.txt and sends the iteration number
+            f = open(name, "w")
+            f.write(text)
+            f.close()
+            left.sendall(struct.pack("!i", 1))
+            right.recv(1024)
+            return parse.getstate(name, 1, maxlength, actionsize, reg2idx)[2]
+        def binarystep():
+            left.sendall(frame)
+            _, payload = protocol.readframe(right)
+            return parse.getstatebinary(payload, maxlength, actionsize, reg2idx)[2]
+        assert (textstep() == binarystep()).all()
+        t = timeit(textstep, repeat)
+        b = timeit(binarystep, repeat)
+        record("transport", "text", t, intervals=count)
+        record("transport", "binary", b, intervals=count)
+        print("%10d %12.3f %12.3f %9.1fx" % (count, t * 1e3, b * 1e3, t / max(b, 1e-9)))
+    left.close()
+    right.close()
+
+def bench_incremental(counts, actionsize=45, maxlength=3000, repeat=20):
+    reg2idx = parse.regtable(dict((str(i), i) for i in range(actionsize)))
+    reward = [[i, i] for i in range(4)]
+    print("%10s %12s %12s %10s" % ("intervals", "full(ms)", "delta(ms)", "speedup"))
+    for count in counts:
+        cols, starts, ends = genintervals(count, actionsize, maxlength)
+        occupancy = np.array([cols, starts, ends]).T
+        _, full = protocol.readframe(framesocket(protocol.packstate(1, 0, 10, reward, [], occupancy)))
+        builder = parse.StateBuilder(maxlength, actionsize)
+        parse.getstatebinary(full, maxlength, actionsize, reg2idx, protocol.STATE, builder)
+        # one interval assigned per step, the same one taken back the next
+        interval = [[5, maxlength / 2, maxlength / 2 + 40]]
+        frames = [protocol.packdelta(2, 0, 10, reward, [], interval, []), protocol.packdelta(3, 0, 10, reward, [], [], interval)]
+        deltas = [protocol.readframe(framesocket(frame))[1] for frame in frames]
+        def deltastep():
+            for delta in deltas:
+                parse.getstatebinary(delta, maxlength, actionsize, reg2idx, protocol.DELTA, builder)
+        f = timeit(lambda: parse.getstatebinary(full, maxlength, actionsize, reg2idx), repeat)
+        d = timeit(deltastep, repeat) / len(deltas)
+        record("incremental", "full", f, intervals=count)
+        record("incremental", "delta", d, intervals=count)
+        print("%10d %12.3f %12.3f %9.1fx" % (count, f * 1e3, d * 1e3, f / max(d, 1e-9)))
+
+def framesocket(frame):
+    left, right = socket.socketpair()
+    left.sendall(frame)
+    left.close()
+    return right
+
+def socketproducer(sock, frame, rounds):
+    for _ in range(rounds):
+        sock.sendall(frame)
+        protocol.unpackaction(protocol.readframe(sock)[1])
+
+def shmproducer(path, frame, rounds):
+    producer = shm.ShmProducer(path)
+    for _ in range(rounds):
+        producer.publish(frame)
+        producer.recvaction()
+    producer.close()
+
+def bench_shm(counts, actionsize=45, maxlength=3000, rounds=200):
+    """
+    One decision round trip, a state frame from a compiler process and the
+    action back, over the framed socket and over the shared memory ring.
+    Decoding is left out, it costs the same on both.
+    """
+    reward = [[i, i] for i in range(4)]
+    path = shm.regionpath(os.getpid())
+    channel = shm.ShmChannel(path)
+    print("%10s %12s %12s %10s" % ("intervals", "socket(ms)", "shm(ms)", "speedup"))
+    for count in counts:
+        cols, starts, ends = genintervals(count, actionsize, maxlength)
+        frame = protocol.packstate(1, 0, 10, reward, [], np.array([cols, starts, ends]).T)
+        left, right = socket.socketpair()
+        p = Process(target=socketproducer, args=(left, frame, rounds))
+        p.start()
+        begin = time.time()
+        for _ in range(rounds):
+            _, payload = protocol.readframe(right)
+            right.sendall(protocol.packaction(1))
+        t = (time.time() - begin) / rounds
+        p.join()
+        left.close()
+        right.close()
+        channel.reset()
+        p = Process(target=shmproducer, args=(path, frame, rounds))
+        p.start()
+        begin = time.time()
+        for _ in range(rounds):
+            _, payload = channel.readframe()
+            channel.sendaction(1)
+        m = (time.time() - begin) / rounds
+        p.join()
+        record("shm", "socket", t, intervals=count)
+        record("shm", "shm", m, intervals=count)
+        print("%10d %12.3f %12.3f %9.1fx" % (count, t * 1e3, m * 1e3, t / max(m, 1e-9)))
+    channel.unlink()
+
+def threadcounts():
+    counts, n = [], 1
+    while n < multiprocessing.cpu_count():
+        counts.append(n)
+        n *= 2
+    return counts + [multiprocessing.cpu_count()]
+
+def bench_tf(actionsize=45, act_batch=1, update_batch=1000, repeat=10, n_layers=2, size=128):
+    """
+    Sweep the TFBackend thread pools over runAction and runOptimizer, the
+    inference and update pools are swept together with the per-op pool
+    """
+    import tensorflow as tf
+    import function
+    ob = np.random.choice([0, 75, 125, 255], (update_batch, actionsize, actionsize, 1)).astype(np.uint8)
+    ac = np.random.randint(0, actionsize, update_batch)
+    adv = np.random.randn(update_batch)
+    best = {}
+    print("%6s %6s %6s %12s %12s" % ("act", "update", "intra", "action(ms)", "update(ms)"))
+    for intra in threadcounts():
+        for inter in threadcounts():
+            tf.reset_default_graph()
+            act = function.ActorFunc(act_threads=inter, update_threads=inter, intra_threads=intra)
+            act.createPred(actionsize, n_layers, size)
+            act.createOptimizer(1e-6)
+            act.run_init()
+            act.run(ob[:act_batch])
+            act.update(ob, ac, adv)
+            a = timeit(lambda: act.run(ob[:act_batch]), repeat)
+            u = timeit(lambda: act.update(ob, ac, adv), max(repeat / 5, 1))
+            act.close()
+            record("tfthreads", "action", a, inter=inter, intra=intra, batch=act_batch)
+            record("tfthreads", "update", u, inter=inter, intra=intra, batch=update_batch)
+            print("%6d %6d %6d %12.3f %12.3f" % (inter, inter, intra, a * 1e3, u * 1e3))
+            for key, t in (("action", a), ("update", u)):
+                if key not in best or t < best[key][0]:
+                    best[key] = (t, inter, intra)
+    for key in ("action", "update"):
+        t, inter, intra = best[key]
+        print("best %s: --%s_threads %d --intra_threads %d (%.3fms)" % (key, "act" if key == "action" else "update", inter, intra, t * 1e3))
+    return best
+
+# (registers in the file, intervals, slot length), realistic to extreme
+STATESIZES = [(45, 100, 3000), (45, 1000, 3000), (200, 1000, 3000), (200, 10000, 30000), (1000, 100000, 300000)]
+
+def bench_parse(sizes=STATESIZES, name="benchstate.txt", actionsize=45, repeat=5):
+    reg2idx = parse.regtable(dict((str(i), i) for i in range(actionsize)))
+    print("%10s %10s %10s %14s %14s" % ("registers", "intervals", "maxlength", "getstate(ms)", "fileToImage(ms)"))
+    for registers, count, maxlength in sizes:
+        genstate(name, count, actionsize, maxlength, registers)
+        g = timeit(lambda: parse.getstate(name, 1, maxlength, actionsize, reg2idx), repeat)
+        f = timeit(lambda: parse.fileToImage(name, 1), repeat)
+        for variant, t in (("getstate", g), ("fileToImage", f)):
+            record("parse", variant, t, registers=registers, intervals=count, maxlength=maxlength)
+        print("%10d %10d %10d %14.3f %14.3f" % (registers, count, maxlength, g * 1e3, f * 1e3))
+    os.remove(name)
+
+def bench_among(candidates=(1, 4, 16, 44), actionsize=45, repeat=2000):
+    """
+    environment.amongcandidates on a sampled action that is a candidate, and
+    on one that is not, which samples again among the candidates
+    """
+    import environment
+    table = parse.regtable(dict((str(i), i) for i in range(actionsize)))
+    distri = np.random.dirichlet(np.ones(actionsize))
+    print("%10s %12s %12s" % ("candidates", "valid(us)", "resample(us)"))
+    for n in candidates:
+        reward_map = parse.candidates([[i, i] for i in range(n)], [], table, actionsize)[2]
+        hit = timeit(lambda: [environment.amongcandidates(distri, reward_map, 0, True) for _ in range(repeat)], 3) / repeat
+        miss = timeit(lambda: [environment.amongcandidates(distri, reward_map, actionsize - 1, False) for _ in range(repeat)], 3) / repeat
+        record("among", "valid", hit, candidates=n)
+        record("among", "resample", miss, candidates=n)
+        print("%10d %12.3f %12.3f" % (n, hit * 1e6, miss * 1e6))
+
+def bench_returns(steps=(1000, 10000, 100000), pathlength=1000, gamma=0.99, repeat=5):
+    print("%10s %14s %14s %14s" % ("steps", "togo(ms)", "episode(ms)", "gae(ms)"))
+    for n in steps:
+        rewards = np.random.randn(n)
+        values = np.random.randn(n)
+        lengths = [pathlength] * (n / pathlength)
+        res = []
+        for variant, fn in (("rewardstogo", lambda: advantage.rewardstogo(rewards, lengths, gamma)),
+                            ("episodereturns", lambda: advantage.episodereturns(rewards, lengths, gamma)),
+                            ("gae", lambda: advantage.gae(rewards, values, lengths, gamma, 0.95))):
+            res.append(timeit(fn, repeat))
+            record("returns", variant, res[-1], steps=n, pathlength=pathlength)
+        print("%10d %14.3f %14.3f %14.3f" % (n, res[0] * 1e3, res[1] * 1e3, res[2] * 1e3))
+
+def bench_actor(batches=(1, 8, 64, 512, 5000), actionsize=45, repeat=5, n_layers=2, size=128):
+    """
+    ActorFunc.run and update of the default network at several batch sizes
+    """
+    import function
+    act = function.ActorFunc()
+    act.createPred(actionsize, n_layers, size)
+    act.createOptimizer(1e-6)
+    act.run_init()
+    print("%10s %12s %12s" % ("batch", "run(ms)", "update(ms)"))
+    for batch in batches:
+        ob = np.random.choice([0, 75, 125, 255], (batch, actionsize, actionsize, 1)).astype(np.uint8)
+        ac = np.random.randint(0, actionsize, batch)
+        adv = np.random.randn(batch)
+        act.run(ob)
+        r = timeit(lambda: act.run(ob), repeat)
+        u = timeit(lambda: act.update(ob, ac, adv), repeat)
+        record("actor", "run", r, batch=batch)
+        record("actor", "update", u, batch=batch)
+        print("%10d %12.3f %12.3f" % (batch, r * 1e3, u * 1e3))
+    act.close()
+
+MOCKMODES = (("text", {}), ("binary", {"binary": True}), ("persistent", {"persistent": True}),
+             ("incremental", {"incremental": True}), ("shm", {"sharedmem": True}))
+
+def bench_mock(steps=200, intervals=1000, episodes=3, port=2850, registers=45, maxlength=3000):
+    """
+    Whole episodes against mockllc.py, spawn, states, greedy actions and
+    the end, in every transport
+    """
+    import environment
+    os.environ.setdefault("RLENS_CONFIG", "rlconfig.mock")
+    os.environ.update({"RLENS_MOCK_STEPS": str(steps), "RLENS_MOCK_INTERVALS": str(intervals),
+                       "RLENS_MOCK_REGISTERS": str(registers), "RLENS_MOCK_MAXLENGTH": str(maxlength)})
+    idx2regs = [str(r) for r in range(1, registers + 1)]
+    regs2idx = dict((r, i) for i, r in enumerate(idx2regs))
+    distri = np.ones(registers)
+    print("%12s %12s %12s" % ("transport", "episodes/s", "steps/s"))
+    for i, (mode, kwargs) in enumerate(MOCKMODES):
+        player = environment.Gplayer(idx2regs, regs2idx, maxlength - 1, "off", "./data/log/", port=port + i, **kwargs)
+        taken = 0
+        begin = time.time()
+        for _ in range(episodes):
+            ob, reward_map = player.reset()
+            done = False
+            while not done:
+                _, ac = player.greedy(distri, reward_map)
+                ob, done, reward_map = player.step(ac)
+                taken += 1
+        t = (time.time() - begin) / episodes
+        record("mock", mode, t, steps=taken / episodes, intervals=intervals)
+        print("%12s %12.2f %12.1f" % (mode, 1 / t, taken / episodes / t))
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+BENCHES = ["occupy", "transport", "incremental", "shm", "parse", "among", "returns"]
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benches', nargs='*', help="any of %s, actor, mock and tf, all but those three by default" % ", ".join(BENCHES))
+    parser.add_argument('--json', type=str, default=None, help="write the results to this file")
+    parser.add_argument('--tf', action='store_true')
+    args = parser.parse_args()
+    benches = args.benches or BENCHES
+    if args.tf:
+        benches = benches + ["tf"]
+    np.random.seed(0)
+    runs = {"occupy": lambda: bench_occupy([10, 100, 1000, 10000]),
+            "transport": lambda: bench_transport([10, 100, 1000, 10000], name="benchstate.txt"),
+            "incremental": lambda: bench_incremental([10, 100, 1000, 10000]),
+            "shm": lambda: bench_shm([10, 100, 1000, 10000]),
+            "parse": bench_parse,
+            "among": bench_among,
+            "returns": bench_returns,
+            "actor": bench_actor,
+            "mock": bench_mock,
+            "tf": bench_tf}
+    for bench in benches:
+        runs[bench]()
+    if args.json:
+        with open(args.json, "w") as out:
+            out.write(json.dumps({"commit": commit(), "time": time.time(), "python": sys.version.split()[0],
+                                  "cpus": multiprocessing.cpu_count(), "results": RESULTS}, indent=1, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
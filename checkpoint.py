@@ -0,0 +1,88 @@
+"""
+
+Checkpoints of the TensorFlow variables, taken every `every` iterations.
+All variables are fetched with one session call on the training thread,
+the pickle is written by a background thread under a temporary name and
+renamed into place, so a checkpoint on disk is always complete.
+
+    keep None:  vars.pkl holds the latest checkpoint, as pickle_tf_vars did
+    keep N:     vars-<iteration>.pkl, only the last N are kept
+
+close takes one more checkpoint of the last iteration when it was not due,
+so the end of training is always saved.
+
+"""
+
+import os
+import time
+import pickle
+import threading
+import atexit
+import Queue
+import tensorflow as tf
+
+
+class Checkpointer:
+    def __init__(self, output_dir, every=1, keep=None):
+        self._output_dir = output_dir
+        self._every = every
+        self._keep = keep
+        self._written = []
+        # the last iteration seen and the last one checkpointed
+        self._last = None
+        self._saved = None
+        self.fetchtime = 0.0
+        self.writetime = 0.0
+        # one checkpoint waits while the previous one is written
+        self._queue = Queue.Queue(1)
+        self._writer = threading.Thread(target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+        atexit.register(self.close)
+
+    def save(self, itr, logz=None):
+        """
+        Take a checkpoint when itr is due, and log the time spent on the
+        training thread and by the last write
+        """
+        begin = time.time()
+        self._last = itr
+        if itr % self._every == 0:
+            self.take(itr)
+        self.fetchtime = time.time() - begin
+        if logz is not None:
+            logz.log_tabular("CheckpointFetch", self.fetchtime)
+            logz.log_tabular("CheckpointWrite", self.writetime)
+
+    def take(self, itr):
+        variables = tf.global_variables()
+        values = tf.get_default_session().run(variables)
+        self._queue.put((itr, dict((v.name, value) for v, value in zip(variables, values))))
+        self._saved = itr
+
+    def close(self):
+        if not self._writer.is_alive():
+            return
+        # at exit the session may be gone already
+        if self._last != self._saved and tf.get_default_session() is not None:
+            self.take(self._last)
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            begin = time.time()
+            itr, values = item
+            name = "vars.pkl" if self._keep is None else "vars-%d.pkl" % itr
+            path = os.path.join(self._output_dir, name)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(values, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(path + ".tmp", path)
+            if self._keep is not None:
+                self._written.append(path)
+                while len(self._written) > self._keep:
+                    os.remove(self._written.pop(0))
+            self.writetime = time.time() - begin
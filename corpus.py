@@ -0,0 +1,183 @@
+"""
+
+A corpus of programs to train on, a directory of .ll files or a manifest
+with one source per line, relative to the manifest, and an optional weight
+
+    program/example.ll 2
+    program/other.ll
+
+Every program keeps its own register profile. Its registers take the first
+action indices, sorted like gen in train_pg, and the rest of the action
+set is never a candidate of its states. CorpusPlayer runs episodes on the
+workers of a VecGplayer and asks the Scheduler for the program of every
+episode it starts:
+
+    recency  the program started least recently
+    cost     the program with the least compiler time per weight so far,
+             episodes still running count at the mean cost of the program
+    uniform  a random program, drawn by weight
+
+"""
+
+import os
+import json
+import time
+import numpy as np
+import environment as en
+import regprofile
+
+POLICIES = ("recency", "cost", "uniform")
+# build_mlp takes 45 x 45 states
+ACTIONSIZE = 45
+
+
+def loadcorpus(path):
+    """
+    The (src, weight) of every program of a directory or manifest
+    """
+    if os.path.isdir(path):
+        return [(os.path.join(path, name), 1.0) for name in sorted(os.listdir(path)) if name.endswith(".ll")]
+    programs = []
+    for line in open(path):
+        fields = line.split("#")[0].split()
+        if not fields:
+            continue
+        src = os.path.join(os.path.dirname(path), fields[0])
+        programs.append((src, float(fields[1]) if len(fields) > 1 else 1.0))
+    return programs
+
+class Program:
+    def __init__(self, src, weight, actionset, maxlength, actionsize):
+        regs = sorted(actionset)
+        if len(regs) > actionsize:
+            raise ValueError("%s uses %d registers, the policy has %d actions" % (src, len(regs), actionsize))
+        self.src = src
+        self.name = os.path.splitext(os.path.basename(src))[0]
+        self.weight = weight
+        self.maxlength = maxlength
+        self.idx2regs = regs + [None] * (actionsize - len(regs))
+        self.regs2idx = dict((reg, i) for i, reg in enumerate(regs))
+        self.started = 0
+        self.running = 0
+        self.episodes = 0
+        self.steps = 0
+        self.seconds = 0.0
+        self.returns = []
+
+    def config(self):
+        # what VecGplayer.reset_async sends to a worker
+        return self.src, self.idx2regs, self.regs2idx, self.maxlength
+
+    def cost(self):
+        mean = self.seconds / self.episodes if self.episodes else 0.0
+        return (self.seconds + self.running * mean) / self.weight
+
+def profile(corpus, actionsize=ACTIONSIZE, log_dir="./data/log/", binary=False, persistent=False, cachedir=regprofile.CACHEDIR, refresh=False, port=en.PORT, workdir=None):
+    """
+    Programs of a loadcorpus list, with the register profile of each one
+    """
+    programs = []
+    for src, weight in corpus:
+        rplayer = en.RandomPlayer(log_dir, binary, persistent, port, workdir, src)
+        actionset, maxlength = regprofile.discover(rplayer, cachedir, refresh)
+        programs.append(Program(src, weight, actionset, maxlength, actionsize))
+    return programs
+
+class Scheduler:
+    def __init__(self, programs, policy="recency", seed=0):
+        if policy not in POLICIES:
+            raise ValueError("unknown policy %s, one of %s" % (policy, ", ".join(POLICIES)))
+        self.programs = programs
+        self._policy = policy
+        self._rng = np.random.RandomState(seed)
+        self._clock = 0
+
+    def next(self):
+        if self._policy == "uniform":
+            weights = np.array([p.weight for p in self.programs], dtype=np.float64)
+            program = self.programs[self._rng.choice(len(self.programs), p=weights / weights.sum())]
+        elif self._policy == "cost":
+            program = min(self.programs, key=lambda p: (p.cost(), p.started))
+        else:
+            program = min(self.programs, key=lambda p: p.started)
+        self._clock += 1
+        program.started = self._clock
+        program.running += 1
+        return program
+
+    def record(self, program, ret, steps, seconds):
+        program.running -= 1
+        program.episodes += 1
+        program.steps += steps
+        program.seconds += seconds
+        program.returns.append(ret)
+
+    def stats(self):
+        """
+        Throughput and returns of every program since the start
+        """
+        res = []
+        for p in self.programs:
+            seconds = max(p.seconds, 1e-9)
+            # the register of every action index
+            res.append({"program": p.name, "src": p.src, "registers": p.idx2regs[:len(p.regs2idx)], "maxlength": p.maxlength,
+                        "episodes": p.episodes, "steps": p.steps, "seconds": p.seconds,
+                        "episodespersecond": p.episodes / seconds, "stepspersecond": p.steps / seconds,
+                        "averagereturn": float(np.mean(p.returns)) if p.returns else 0.0,
+                        "stdreturn": float(np.std(p.returns)) if p.returns else 0.0,
+                        "lastreturn": p.returns[-1] if p.returns else 0.0})
+        return res
+
+class CorpusPlayer(en.VecGplayer):
+    """
+    VecGplayer whose workers switch programs between episodes. The return,
+    steps and wall time of every episode go to the Scheduler, latency
+    writes its per-program stats to statspath and logs a summary.
+    """
+    def __init__(self, scheduler, nenvs, trajmode, log_dir, statspath=None, **kwargs):
+        first = scheduler.programs[0]
+        en.VecGplayer.__init__(self, nenvs, first.idx2regs, first.regs2idx, first.maxlength, trajmode, log_dir, **kwargs)
+        self._scheduler = scheduler
+        self._statspath = statspath
+        # worker -> [program, return, steps, start, reward_map]
+        self._running = {}
+
+    def reset_async(self, i):
+        program = self._scheduler.next()
+        self._running[i] = [program, 0.0, 0, time.time(), None]
+        en.VecGplayer.reset_async(self, i, program.config())
+
+    def step_async(self, i, action):
+        run = self._running[i]
+        run[1] += int(run[4][0][action])
+        run[2] += 1
+        en.VecGplayer.step_async(self, i, action)
+
+    def poll(self, timeout=None, waitall=False):
+        res = en.VecGplayer.poll(self, timeout, waitall)
+        for i, ob, done, reward_map in res:
+            if done:
+                self.finish(i)
+            else:
+                self._running[i][4] = reward_map
+        return res
+
+    def abort(self, i):
+        en.VecGplayer.abort(self, i)
+        self.finish(i)
+
+    def finish(self, i):
+        program, ret, steps, begin, _ = self._running.pop(i)
+        self._scheduler.record(program, ret, steps, time.time() - begin)
+
+    def latency(self):
+        res = en.VecGplayer.latency(self)
+        stats = self._scheduler.stats()
+        if self._statspath is not None:
+            with open(self._statspath, "w") as out:
+                out.write(json.dumps(stats, indent=1, sort_keys=True))
+        episodes = [s["episodes"] for s in stats]
+        res["CorpusProgramsSeen"] = sum(1 for n in episodes if n)
+        res["CorpusEpisodesMin"] = min(episodes)
+        res["CorpusEpisodesMax"] = max(episodes)
+        return res
@@ -0,0 +1,130 @@
+"""
+
+Offline trajectory dataset. Rollouts are appended by DatasetWriter and read
+back by Dataset through np.memmap, so the network can be trained on
+recorded decisions without starting the compiler.
+
+    meta.json     action size, observation shape and record counts
+    obs.bin       uint8 observations, each distinct one stored once
+    digests.bin   sha1 of every stored observation, rebuilds the dedup index
+    steps.bin     one step record per decision, see stepdtype
+
+The counts in meta.json are written last, a reader ignores anything past
+them, so an interrupted writer never leaves a half record visible.
+
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import advantage
+
+DIGEST = 20
+
+
+def stepdtype(actionsize):
+    return np.dtype([("obs", "<i8"),
+                     ("action", "<i4"),
+                     ("reward", "<f4"),
+                     ("episode", "<i4"),
+                     ("mask", "u1", ((actionsize + 7) / 8,))])
+
+def readmeta(path):
+    return json.load(open(os.path.join(path, "meta.json")))
+
+class DatasetWriter:
+    def __init__(self, path, actionsize, obshape=None):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._path = path
+        if os.path.exists(os.path.join(path, "meta.json")):
+            self.meta = readmeta(path)
+            assert self.meta["actionsize"] == actionsize, "Dataset %s has %d actions, not %d" % (path, self.meta["actionsize"], actionsize)
+        else:
+            obshape = obshape or (actionsize, actionsize, 1)
+            self.meta = {"actionsize": actionsize, "obshape": list(obshape), "observations": 0, "steps": 0, "episodes": 0}
+        self._dtype = stepdtype(actionsize)
+        # drop whatever an interrupted writer left past the recorded counts
+        for name, size in (("obs.bin", self.meta["observations"] * int(np.prod(self.meta["obshape"]))),
+                           ("digests.bin", self.meta["observations"] * DIGEST),
+                           ("steps.bin", self.meta["steps"] * self._dtype.itemsize)):
+            f = open(os.path.join(path, name), "ab")
+            f.truncate(size)
+            f.close()
+        digests = open(os.path.join(path, "digests.bin"), "rb").read()
+        self._index = dict((digests[i:i + DIGEST], i / DIGEST) for i in range(0, len(digests), DIGEST))
+
+    def addpath(self, path):
+        """
+        Append one path of PolicyGradient, with "mask" holding the candidate
+        registers of every step as a boolean (steps, actionsize) array
+        """
+        n = len(path["reward"])
+        steps = np.zeros(n, dtype=self._dtype)
+        obs, digests = [], []
+        for i, ob in enumerate(path["observation"]):
+            data = np.asarray(ob, dtype=np.uint8).tostring()
+            digest = hashlib.sha1(data).digest()
+            idx = self._index.get(digest)
+            if idx is None:
+                idx = len(self._index)
+                self._index[digest] = idx
+                obs.append(data)
+                digests.append(digest)
+            steps["obs"][i] = idx
+        steps["action"] = path["action"]
+        steps["reward"] = path["reward"]
+        steps["episode"] = self.meta["episodes"]
+        steps["mask"] = np.packbits(np.asarray(path["mask"], dtype=bool), axis=1)
+        for name, data in (("obs.bin", "".join(obs)), ("digests.bin", "".join(digests)), ("steps.bin", steps.tostring())):
+            f = open(os.path.join(self._path, name), "ab")
+            f.write(data)
+            f.close()
+        self.meta["observations"] += len(obs)
+        self.meta["steps"] += n
+        self.meta["episodes"] += 1
+        tmp = os.path.join(self._path, "meta.json.tmp")
+        with open(tmp, "w") as out:
+            out.write(json.dumps(self.meta))
+        os.rename(tmp, os.path.join(self._path, "meta.json"))
+
+class Dataset:
+    def __init__(self, path):
+        self.meta = readmeta(path)
+        self.actionsize = self.meta["actionsize"]
+        shape = tuple(self.meta["obshape"])
+        nobs, nsteps = self.meta["observations"], self.meta["steps"]
+        assert nsteps > 0, "Dataset %s is empty" % path
+        self.obs = np.memmap(os.path.join(path, "obs.bin"), dtype=np.uint8, mode="r", shape=(nobs,) + shape)
+        self.steps = np.memmap(os.path.join(path, "steps.bin"), dtype=stepdtype(self.actionsize), mode="r", shape=(nsteps,))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def returns(self, gamma, reward_to_go=True):
+        """
+        Discounted return of every step within its episode, or of the whole
+        episode when reward_to_go is off
+        """
+        rewards = np.asarray(self.steps["reward"], dtype=np.float64)
+        episodes = np.asarray(self.steps["episode"])
+        bounds = np.r_[0, np.flatnonzero(np.diff(episodes)) + 1, len(rewards)]
+        if reward_to_go:
+            return advantage.rewardstogo(rewards, np.diff(bounds), gamma)
+        return advantage.episodereturns(rewards, np.diff(bounds), gamma)
+
+    def masks(self, steps):
+        return np.unpackbits(steps["mask"], axis=1)[:, :self.actionsize].astype(bool)
+
+    def minibatches(self, batch_size, gamma, reward_to_go=True, shuffle=True):
+        """
+        Yield (ob_no, ac_na, q_n, mask_na) minibatches for ActorFunc.update,
+        each one read in index order to keep the memmap access sequential
+        """
+        q = self.returns(gamma, reward_to_go)
+        order = np.random.permutation(len(self)) if shuffle else np.arange(len(self))
+        for begin in range(0, len(order), batch_size):
+            idx = np.sort(order[begin:begin + batch_size])
+            steps = self.steps[idx]
+            yield self.obs[steps["obs"]], np.asarray(steps["action"]), q[idx], self.masks(steps)
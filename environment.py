@@ -4,19 +4,78 @@ import subprocess
 import random
 import os
 import struct
+import sys
+import time
+import select
 import parse
+import protocol
+import trajectory
+import shm
+import timing
+import atexit
 import socket
+from multiprocessing import Process, Pipe
 HOST = '127.0.0.1'
 PORT = 1992
-os.environ["CUDA_VISIBLE_DEVICES"] = "3"
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-sock.bind((HOST, PORT))
+socks = {}
+
+# one listening socket per port, shared by every player in the process. The
+# port of a finished run is bound again by the next one, even while its last
+# connections linger in TIME_WAIT
+def listen(port=PORT):
+  if port not in socks:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, port))
+    sock.listen(5)
+    socks[port] = sock
+  return socks[port]
 
 
 class Player:
-  def __init__(self, log_dir="./data/log/"):
+  def __init__(self, log_dir="./data/log/", port=PORT, workdir=None, src=None):
       self._iter = 1
       self._log_dir = log_dir
+      self._port = port
+      # the compiler writes state.txt into its working directory
+      self._workdir = workdir
+      self._statefile = os.path.join(workdir or ".", "state.txt")
+      self._spawnenv = {"RLENS_PORT": str(port)}
+      f = open(os.environ.get("RLENS_CONFIG", "rlconfig"), 'r')
+      self._llc = os.path.abspath(f.readline().split(' ')[2].replace("\n", ""))
+      self._src = os.path.abspath(f.readline().split(' ')[2].replace("\n", ""))
+      self._target = os.path.abspath(f.readline().split(' ')[2].replace("\n", ""))
+      f.close()
+      # players side by side each compile into their own working directory
+      if workdir:
+        self._target = os.path.join(os.path.abspath(workdir), os.path.basename(self._target))
+      if src is not None:
+        self.usesource(src)
+
+  # compile src instead of the rlconfig source, the output goes next to the
+  # rlconfig target, or into the working directory
+  def usesource(self, src):
+      name = os.path.splitext(os.path.basename(src))[0] + ".s"
+      self._src = os.path.abspath(src)
+      self._target = os.path.join(os.path.abspath(self._workdir) if self._workdir else os.path.dirname(self._target), name)
+
+  def command(self):
+      return [self._llc, '-debug-only=regallocdl', '--regalloc=drl', self._src, '-o', self._target]
+
+  # tell the compiler how messages are framed
+  def framing(self):
+      if self._binary:
+        self._spawnenv["RLENS_BINARY"] = "1"
+      if self._persistent:
+        self._spawnenv["RLENS_PERSISTENT"] = "1"
+
+  # start the compiler, it connects back to RLENS_PORT. It must not inherit
+  # the listening sockets, a compiler left over by a closed worker would
+  # otherwise connect to its own copy and wait forever
+  def spawn(self):
+      env = dict(os.environ)
+      env.update(self._spawnenv)
+      return subprocess.Popen(self.command(),shell=False, stdout=subprocess.PIPE, cwd=self._workdir, env=env, close_fds=True)
 
   def reset(self):
       return;
@@ -27,54 +86,62 @@ class Player:
 
 
 class RandomPlayer(Player):
-  def __init__(self, log_dir):
-    Player.__init__(self, log_dir)
+  def __init__(self, log_dir, binary=False, persistent=False, port=PORT, workdir=None, src=None):
+    Player.__init__(self, log_dir, port, workdir, src)
+    # a persistent connection frames every message, so it implies binary
+    self._binary = binary or persistent
+    self._persistent = persistent
+    self.framing()
     self._total_reward = 0.0
-    self._sock = sock
-    self._sock.listen(5)
-    f = open('rlconfig', 'r')
-    self._llc = f.readline().split(' ')[2].replace("\n", "")
-    self._src = f.readline().split(' ')[2].replace("\n", "")
-    self._target = f.readline().split(' ')[2].replace("\n", "")
-    f.close()
+    self._sock = listen(port)
 
   def reset(self):
       self._iter = 1
-      self._p = subprocess.Popen([self._llc, '-debug-only=regallocdl', '--regalloc=drl', self._src, '-o', self._target],shell=False, stdout=subprocess.PIPE)
+      self._p = self.spawn()
 
   def step(self):
     terminal = False
     actions = set()
     maxlength = 0
+    conn = None
     while (terminal == False):
-      print "start accept " + str(self._iter)
-      conn, addr = self._sock.accept()
-      data = conn.recv(1024)
-      if (data[0] == 'e'):
+      if conn is None or not self._persistent:
+        print "start accept " + str(self._iter)
+        conn, addr = self._sock.accept()
+      kind, data = recvstate(conn, self._binary)
+      if kind == protocol.END:
         terminal = True
         break
-      reward_map, sortedr, slotend = self.getState(data)
+      reward_map, sortedr, slotend = self.getState(kind, data)
       maxlength = max(slotend, maxlength)
       action, score = self.doAction(sortedr)
-      conn.send(str(action))
+      sendaction(conn, action, self._persistent)
       self._iter = self._iter + 1
       self._total_reward = self._total_reward + int(score)
       for g in reward_map.keys():
         actions.add(g)
 
+    if self._persistent:
+      conn.close()
     print "the totalreward is " + str(self._total_reward)
     self._iter = 1 
     self._total_reward = 0.0
     self.terminate()
     return actions, maxlength
 
-  def getState(self, data):
+  def getState(self, kind, data):
 
-      data = struct.unpack("!i", data)[0]
+      if self._binary:
+          data, _, maxlength, reward_map, vreward_map = parse.readbinary(data, kind)[:5]
+          reward_map.update(vreward_map)
+          sortedr = sorted(reward_map.items(), key=lambda d: int(d[1]))
+      else:
+          data = struct.unpack("!i", data)[0]
       if int(data) != self._iter:
-          print "c++ iter: " + data + " python iter: " + str(self._iter)
+          print "c++ iter: " + str(data) + " python iter: " + str(self._iter)
           sys.exit(0)
-      state, reward_map, sortedr, maxlength, _ = parse.fileToImage("state.txt", self._iter)
+      if not self._binary:
+          state, reward_map, sortedr, maxlength, _ = parse.fileToImage(self._statefile, self._iter)
       return reward_map, sortedr, maxlength
 
   def doAction(self, reward_map):
@@ -88,110 +155,412 @@ class RandomPlayer(Player):
     print "process finish"
 
 class Gplayer(Player):
-  def __init__(self, idx2regs, regs2idx, maxlength, tofile, log_dir):
-    Player.__init__(self, log_dir)
-    self._sock = sock
-    self._sock.listen(5)
+  def __init__(self, idx2regs, regs2idx, maxlength, trajmode, log_dir, binary=False, persistent=False, port=PORT, workdir=None, incremental=False, checkstate=False, sharedmem=False, trace_every=0):
+    Player.__init__(self, log_dir, port, workdir)
+    # a persistent connection frames every message, so it implies binary,
+    # and so do the delta frames of incremental states. The shared memory
+    # channel is persistent and replaces the socket.
+    self._binary = binary or persistent or incremental or sharedmem
+    self._persistent = persistent or sharedmem
+    self.framing()
+    self._setup = []
+    self._send = []
+    self._roundtrip = []
+    self._channel = None
+    if sharedmem:
+      region = shm.regionpath(port)
+      self._channel = shm.ShmChannel(region)
+      atexit.register(self._channel.unlink)
+      self._spawnenv["RLENS_SHM"] = region
+    else:
+      self._sock = listen(port)
+    self._actionsize = len(idx2regs)
+    self._checkstate = checkstate
+    self._builder = None
+    self.useregisters(idx2regs, regs2idx, maxlength)
+    if incremental:
+      # ask the compiler for delta frames after the first state
+      self._builder = parse.StateBuilder(self._maxlength, self._actionsize, checkstate)
+      self._spawnenv["RLENS_DELTA"] = "1"
+    self._traj = trajectory.TrajectoryLog(log_dir, trajmode)
+    # a Chrome trace of every trace_every-th episode
+    self._trace_every = trace_every
+    self._episode = 0
+
+  def useregisters(self, idx2regs, regs2idx, maxlength):
     self._idx2Regs = idx2regs
     self._regs2idx = regs2idx
+    # register numbers to action indices, once for every state
+    self._regtable = parse.regtable(regs2idx)
     self._maxlength = maxlength + 1
-    self._actionsize = len(idx2regs)
-    self._tofile = tofile
-    f = open('rlconfig', 'r')
-    self._llc = f.readline().split(' ')[2].replace("\n", "")
-    self._src = f.readline().split(' ')[2].replace("\n", "")
-    self._target = f.readline().split(' ')[2].replace("\n", "")
-    f.close()
+
+  # play src from the next reset on, with its own registers and maxlength,
+  # idx2regs keeps the length of the action set
+  def retarget(self, src, idx2regs, regs2idx, maxlength):
+    self.usesource(src)
+    self.useregisters(idx2regs, regs2idx, maxlength)
+    if self._builder is not None:
+      self._builder = parse.StateBuilder(self._maxlength, self._actionsize, self._checkstate)
 
   def terprocess(self):
       print "terminal the process in python"
       #self._p.terminate()
+      if self._persistent and self._channel is None:
+        self._conn.close()
+      self._traj.end()
+      self.endtrace()
+      self._p.wait()
+
+  # give up on the running episode, the compiler is still waiting for an action
+  def abort(self):
+      self._traj.end()
+      self.endtrace()
+      if self._channel is None:
+        self._conn.close()
+      self._p.terminate()
       self._p.wait()
 
+  def endtrace(self):
+      if self._trace_every and timing.tracing():
+        timing.stoptrace(os.path.join(self._log_dir, "trace%d.json" % self._episode))
+
   def reset(self):
-    self._p = subprocess.Popen([self._llc, '-debug-only=regallocdl', '--regalloc=drl', self._src, '-o', self._target],shell=False, stdout=subprocess.PIPE)
+    if self._channel is not None:
+      # empty the ring before the compiler can publish into it
+      self._channel.reset()
+    self._p = self.spawn()
     print "start accept " + str(self._iter)
     self._iter = 1
-    self._conn, addr = self._sock.accept()
-    data = self._conn.recv(1024)
-    state, reward_map = self.getState(data)
+    self._traj.begin()
+    self._episode += 1
+    if self._trace_every and self._episode % self._trace_every == 1 % self._trace_every:
+      timing.starttrace()
+    with timing.phase("Compiler"):
+      if self._channel is not None:
+        self._channel.watch(self._p)
+        self._conn = self._channel
+      else:
+        begin = time.time()
+        with timing.phase("Accept"):
+          self._conn, addr = self._sock.accept()
+        # the one connection of a persistent episode
+        self._setup.append(time.time() - begin)
+      with timing.phase("Recv"):
+        kind, data = recvstate(self._conn, self._binary)
+    state, reward_map = self.getState(kind, data)
     return state, reward_map
 
   def step(self, action):
-    #for log action data
-
-    self.log(action)
     #prepare action and send action
+    reward = self._reward_map[0][action]
     action = self._idx2Regs[action]
-    self._conn.send(str(action))
+    #for log action data
+    self._traj.action(self._iter, action)
+    self._traj.reward(self._iter, int(reward))
+    begin = time.time()
+    with timing.phase("Send"):
+      sendaction(self._conn, action, self._persistent)
+    sent = time.time()
+    self._send.append(sent - begin)
     self._iter = self._iter + 1
-    self._conn, addr = self._sock.accept()
-    data = self._conn.recv(1024)
-    if data[0] == 'e':
+    if not self._persistent:
+      with timing.phase("Accept"):
+        self._conn, addr = self._sock.accept()
+      self._setup.append(time.time() - sent)
+    with timing.phase("Recv"):
+      kind, data = recvstate(self._conn, self._binary)
+    self._roundtrip.append(time.time() - begin)
+    timing.add("Compiler", self._roundtrip[-1], begin)
+    if kind == protocol.END:
         self.terprocess()
         return [], True, []
 
     #get the next state after do action 
-    state, reward_map = self.getState(data)
+    state, reward_map = self.getState(kind, data)
     return state, False, reward_map
 
-  def getState(self, data):
-    data = struct.unpack("!i", data)[0]
+  @timing.phase("Parse")
+  def getState(self, kind, payload):
+    if self._binary:
+      # the binary frame carries the whole state, no state.txt round trip
+      state, reward_map, _, data = parse.getstatebinary(payload, self._maxlength, self._actionsize, self._regtable, kind, self._builder)
+    else:
+      data = struct.unpack("!i", payload)[0]
     # unpack the socket data to test if it is terminated 
     if int(data) != self._iter:
-      print "c++ iter: " + data + " python iter: " + str(self._iter)
+      print "c++ iter: " + str(data) + " python iter: " + str(self._iter)
       sys.exit(0)
 
     # parse the state data which is outputed from compiler
-    state, reward_map, _ = parse.getstate("state.txt", self._iter, self._maxlength, self._actionsize, self._regs2idx, self._tofile)
+    if not self._binary:
+      state, reward_map, _ = parse.getstate(self._statefile, self._iter, self._maxlength, self._actionsize, self._regtable)
+    if self._traj.recording():
+      self._traj.state(self._iter, payload if self._binary else open(self._statefile).read(), kind if self._binary else None)
+    self._reward_map = reward_map
     return state, reward_map
 
-  # test the action is valid
   def among(self, distri, reward_map, ac, valid):
-    ac = self._idx2Regs[ac]
-    if valid and reward_map.get(str(ac)) != None:
-        reward = reward_map[str(ac)]
-        ac = self._regs2idx[str(ac)]
-        return int(reward), ac, True
-    elif valid and reward_map.get(str(ac)) == None:
-        ac = self._regs2idx[str(ac)]
+    return amongcandidates(distri, reward_map, ac, valid)
+
+  def mask(self, reward_map):
+    return candidatemask(reward_map)
+
+  def greedy(self, distri, reward_map):
+    return greedyaction(distri, reward_map)
+
+  # per step in seconds since the last call, the round trip from sending an
+  # action to the next state, the time spent accepting connections, one per
+  # step or only the one of reset when persistent, and sending actions. And
+  # the trajectory records dropped so far
+  def latency(self):
+    steps = max(len(self._roundtrip), 1)
+    res = {"StepRoundTrip": sum(self._roundtrip) / steps, "StepSetup": sum(self._setup) / steps,
+           "StepSend": sum(self._send) / steps, "TrajectoryDropped": self._traj.dropped}
+    self._setup = []
+    self._send = []
+    self._roundtrip = []
+    return res
+
+class CachedGplayer(Gplayer):
+  """
+  Gplayer answering episodes from an outcome.OutcomeCache. llc is only
+  spawned when the action sequence leaves the cached trie, it is then fed
+  the cached prefix again and the rest of the episode runs live and is
+  added to the cache.
+  """
+  def __init__(self, cache, idx2regs, regs2idx, maxlength, trajmode, log_dir, **kwargs):
+    Gplayer.__init__(self, idx2regs, regs2idx, maxlength, trajmode, log_dir, **kwargs)
+    self._cache = cache
+    self._episodes = 0
+    self._cachedepisodes = 0
+    atexit.register(cache.save)
+
+  def reset(self):
+    self._episodes += 1
+    self._actions = []
+    self._live = False
+    self._node = self._cache.child(None, None)
+    if self._node is None:
+      self._cache.misses += 1
+      state, reward_map = self.golive()
+      self._node = self._cache.add(None, None, state, reward_map, False)
+      return state, reward_map
+    self._cache.hits += 1
+    state, self._reward_map, _ = self._cache.state(self._node)
+    return state, self._reward_map
+
+  def step(self, action):
+    self._actions.append(action)
+    if not self._live:
+      node = self._cache.child(self._node, action)
+      if node is not None:
+        self._cache.hits += 1
+        self._node = node
+        state, self._reward_map, done = self._cache.state(node)
+        if done:
+          self._cachedepisodes += 1
+        return state, done, self._reward_map
+      self.golive()
+      # replay the cached prefix, the compiler is deterministic
+      for ac in self._actions[:-1]:
+        Gplayer.step(self, ac)
+    self._cache.misses += 1
+    state, done, reward_map = Gplayer.step(self, action)
+    self._node = self._cache.add(self._node, action, state, reward_map, done)
+    return state, done, reward_map
+
+  def golive(self):
+    self._live = True
+    return Gplayer.reset(self)
+
+  def abort(self):
+    if self._live:
+      Gplayer.abort(self)
+
+  def latency(self):
+    res = Gplayer.latency(self)
+    res["CacheHitRate"] = self._cache.hitrate()
+    res["CachedEpisodes"] = self._cachedepisodes / float(max(self._episodes, 1))
+    res["CacheNodes"] = len(self._cache)
+    self._cache.hits = 0
+    self._cache.misses = 0
+    self._episodes = 0
+    self._cachedepisodes = 0
+    return res
+
+
+def vecworker(remote, args, kwargs):
+  env = Gplayer(*args, **kwargs)
+  while True:
+    cmd, data = remote.recv()
+    if cmd == "reset":
+      if data is not None:
+        env.retarget(*data)
+      ob, reward_map = env.reset()
+      remote.send((ob, False, reward_map))
+    elif cmd == "step":
+      remote.send(env.step(data))
+    elif cmd == "abort":
+      env.abort()
+    elif cmd == "latency":
+      remote.send(env.latency())
+    elif cmd == "timing":
+      remote.send(timing.collect())
+    elif cmd == "close":
+      remote.close()
+      break
+
+class VecGplayer:
+  """
+  Runs nenvs Gplayers in worker processes, each with its own port and
+  working directory, so nenvs compilers run side by side. Workers are
+  stepped in lockstep with reset/step, or as they become ready with
+  reset_async/step_async/poll. among, mask and greedy are the module
+  functions Gplayer uses too.
+  """
+  def __init__(self, nenvs, idx2regs, regs2idx, maxlength, trajmode, log_dir, binary=False, persistent=False, port=PORT, workdir="./data/worker", incremental=False, checkstate=False, sharedmem=False, trace_every=0):
+    self._idx2Regs = idx2regs
+    self._regs2idx = regs2idx
+    self.nenvs = nenvs
+    self._remotes = []
+    self._procs = []
+    self._pending = set()
+    for i in range(nenvs):
+      wdir = workdir + str(i)
+      wlog = os.path.join(wdir, os.path.basename(os.path.normpath(log_dir))) + "/"
+      if not os.path.exists(wlog):
+        os.makedirs(wlog)
+      remote, child = Pipe()
+      kwargs = {"binary": binary, "persistent": persistent, "port": port + i, "workdir": wdir, "incremental": incremental, "checkstate": checkstate, "sharedmem": sharedmem, "trace_every": trace_every}
+      p = Process(target=vecworker, args=(child, (idx2regs, regs2idx, maxlength, trajmode, wlog), kwargs))
+      p.daemon = True
+      p.start()
+      child.close()
+      self._remotes.append(remote)
+      self._procs.append(p)
+
+  # program is the (src, idx2regs, regs2idx, maxlength) the worker switches
+  # to, None keeps the current one
+  def reset_async(self, i, program=None):
+    self._remotes[i].send(("reset", program))
+    self._pending.add(i)
+
+  def step_async(self, i, action):
+    self._remotes[i].send(("step", action))
+    self._pending.add(i)
+
+  def abort(self, i):
+    self._remotes[i].send(("abort", None))
+
+  def among(self, distri, reward_map, ac, valid):
+    return amongcandidates(distri, reward_map, ac, valid)
+
+  def mask(self, reward_map):
+    return candidatemask(reward_map)
+
+  def greedy(self, distri, reward_map):
+    return greedyaction(distri, reward_map)
+
+  # (i, ob, done, reward_map) of the workers that answered, waiting for at
+  # least one of them, or for all of them when waitall is set
+  def poll(self, timeout=None, waitall=False):
+    res = []
+    while self._pending and (not res or waitall):
+      fds = dict((self._remotes[i].fileno(), i) for i in self._pending)
+      ready, _, _ = select.select(fds.keys(), [], [], timeout)
+      if not ready:
+        break
+      for fd in ready:
+        i = fds[fd]
+        ob, done, reward_map = self._remotes[i].recv()
+        self._pending.discard(i)
+        res.append((i, ob, done, reward_map))
+    return res
+
+  def collect(self):
+    res = sorted(self.poll(waitall=True))
+    return [r[1] for r in res], [r[2] for r in res], [r[3] for r in res]
+
+  def reset(self):
+    for i in range(self.nenvs):
+      self.reset_async(i)
+    obs, _, reward_maps = self.collect()
+    return np.array(obs), reward_maps
+
+  def step(self, actions):
+    for i in range(self.nenvs):
+      self.step_async(i, actions[i])
+    obs, dones, reward_maps = self.collect()
+    return obs, np.array(dones), reward_maps
+
+  def latency(self):
+    for remote in self._remotes:
+      remote.send(("latency", None))
+    stats = [remote.recv() for remote in self._remotes]
+    return dict((key, np.mean([s[key] for s in stats])) for key in stats[0])
+
+  # add the phase times of the workers to the ones of this process
+  def timing(self):
+    for remote in self._remotes:
+      remote.send(("timing", None))
+    for remote in self._remotes:
+      timing.merge(*remote.recv())
+
+  def close(self):
+    for remote in self._remotes:
+      remote.send(("close", None))
+    for p in self._procs:
+      p.join()
+
+
+# read one state message as (kind, data), kind is END when the compiler ends
+# the episode, in text mode data is the iteration number of state.txt
+def recvstate(conn, binary):
+    if not binary:
+        data = conn.recv(1024)
+        if data[0] == 'e':
+            return protocol.END, None
+        return protocol.STATE, data
+    if isinstance(conn, shm.ShmChannel):
+        return conn.readframe()
+    return protocol.readframe(conn)
+
+def sendaction(conn, action, framed):
+    if isinstance(conn, shm.ShmChannel):
+        conn.sendaction(action)
+    elif framed:
+        conn.sendall(protocol.packaction(action))
+    else:
+        conn.send(str(action))
+
+# test the action is valid, reward_map is the (reward, mask) pair of arrays
+# over the action indices that parse returns
+@timing.phase("Among")
+def amongcandidates(distri, reward_map, ac, valid):
+    reward, mask = reward_map
+    if mask[ac]:
+        return int(reward[ac]), ac, True
+    if valid:
         return 0.000001, ac, False
-    elif not valid and reward_map.get(str(ac)) != None:
-        reward = reward_map[str(ac)]
-        ac = self._regs2idx[str(ac)]
-        return int(reward), ac, True
-
-    # find the register which is in the candidate list
-    finalidx2reg = {}
-    index = 0
-    actions = [] 
-    for i in self._regs2idx.keys():
-        if reward_map.get(str(i)) != None:
-            actions.insert(index, distri[self._regs2idx[str(i)]])
-            finalidx2reg[str(index)] = i
-            index = index + 1   
+
+    # sample among the candidate registers
+    cands = np.flatnonzero(mask)
     #the comment part is the epislon greedy
     #if random.random() < 0.05:
-    actions = softmax(actions)
-    action = np.random.choice(index, 1, p=actions)
-    action = action[0]
+    action = np.random.choice(cands, 1, p=softmax(distri[cands]))[0]
     #else:
-    #  actions = softmax(actions)
-    #  action = np.random.choice(index, 1, p=actions)
-    #  action = action[0]
-      #action = np.argmax(np.array(actions))
-    action = finalidx2reg[str(action)]
-    reward = reward_map[str(action)]
-    action = self._regs2idx[str(action)]
-    return int(reward), action, True
-
-  def log(self, action):
-    name = self._log_dir + "action" + str(self._iter) + ".txt"
-    f = open(name, "w")
-    f.write(str(action))
-    f.close()
+    #  action = cands[np.argmax(distri[cands])]
+    return int(reward[action]), int(action), True
 
+# candidate registers of reward_map as a mask over the action indices
+def candidatemask(reward_map):
+    return reward_map[1]
 
+# the most likely candidate register, for evaluation rollouts
+def greedyaction(distri, reward_map):
+    reward, mask = reward_map
+    ac = int(np.argmax(np.where(mask, distri, -np.inf)))
+    return int(reward[ac]), ac
 
 # helper function for simple reinforcement learning example 
 def among(distri, ac, valid):
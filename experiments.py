@@ -0,0 +1,225 @@
+"""
+
+Runs train_pg.py for every seed of every configuration of a grid, side by
+side. Every run is a process of its own, so TensorFlow and the listening
+sockets never meet, and holds one of `jobs` slots while it runs. A slot is
+
+    ports    base + slot * stride on, --port of train_pg, VecGplayer
+             workers take the next n_envs of them
+    cpus     its share of the machine, the run starts under taskset,
+             unless --no_pin
+
+and every run writes under <root>/<config>/<seed>/ through --rundir, its
+output in out.txt. Slots are reused, never shared. When all runs are done
+the last row of every log.txt goes into summary.tsv, with one more row per
+configuration holding the mean and std of every column over its seeds, and
+into summary.json.
+
+    python experiments.py CartPole-v0 --seeds 1 11 21 --jobs 3 \\
+        --grid learning_rate=1e-6,1e-5 --grid overlap=true,false \\
+        -- -n 10 -b 1000 -rtg --persistent
+
+A grid value true passes the flag alone, false leaves it out.
+
+"""
+
+import os
+import sys
+import json
+import time
+import itertools
+import subprocess
+import multiprocessing
+import distutils.spawn
+import numpy as np
+import environment as en
+
+TRAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train_pg.py")
+
+
+def parsegrid(specs):
+    """
+    Every combination of a list of "key=v1,v2" specs, as (name, options)
+    """
+    keys = []
+    values = []
+    for spec in specs:
+        key, _, vals = spec.partition("=")
+        keys.append(key)
+        values.append(vals.split(","))
+    res = []
+    for combo in itertools.product(*values):
+        options = []
+        for key, val in zip(keys, combo):
+            if val == "false":
+                continue
+            options.append("--" + key)
+            if val != "true":
+                options.append(val)
+        name = "_".join("%s=%s" % (key, val.replace(os.sep, "-")) for key, val in zip(keys, combo)) or "default"
+        res.append((name, options))
+    return res
+
+def cpusets(jobs, ncpus):
+    """
+    A taskset cpu list for every slot, contiguous shares of ncpus cpus,
+    slots share cpus only when there are more slots than cpus
+    """
+    if jobs >= ncpus:
+        return [str(slot % ncpus) for slot in range(jobs)]
+    res = []
+    for slot in range(jobs):
+        first = slot * ncpus / jobs
+        last = (slot + 1) * ncpus / jobs - 1
+        res.append("%d-%d" % (first, last))
+    return res
+
+def nenvs(options):
+    # the workers of a run bind port .. port + n_envs - 1, the options are
+    # read the way train_pg reads them
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_envs', type=int, default=1)
+    return parser.parse_known_args(options)[0].n_envs
+
+class Run:
+    def __init__(self, config, options, seed, rundir):
+        self.config = config
+        self.options = options
+        self.seed = seed
+        self.rundir = rundir
+        self.slot = None
+        self.returncode = None
+        self.seconds = 0.0
+
+    def command(self, env_name, port, cpus, taskset):
+        # taskset None leaves the run unpinned
+        cmd = [sys.executable, TRAIN, env_name, "--exp_name", self.config, "--seed", str(self.seed),
+               "-e", "1", "--port", str(port), "--rundir", self.rundir] + self.options
+        if taskset:
+            return [taskset, "-c", cpus] + cmd
+        return cmd
+
+    def log(self):
+        """
+        The last row of the log.txt of the run as a dict, empty without one
+        """
+        for dirpath, _, names in os.walk(self.rundir):
+            if "log.txt" in names:
+                lines = open(os.path.join(dirpath, "log.txt")).read().splitlines()
+                if len(lines) < 2:
+                    return {}
+                return dict(zip(lines[0].split("\t"), lines[-1].split("\t")))
+        return {}
+
+def launch(runs, env_name, jobs, port, stride, cpus, pin=True):
+    """
+    Run them all, at most jobs at a time, returns when every run ended
+    """
+    taskset = None
+    if pin:
+        taskset = distutils.spawn.find_executable("taskset")
+        if taskset is None:
+            raise OSError("taskset is not installed, run with --no_pin")
+    free = range(jobs)
+    pending = list(runs)
+    running = {}
+    while pending or running:
+        while pending and free:
+            run = pending.pop(0)
+            run.slot = free.pop(0)
+            if not os.path.exists(run.rundir):
+                os.makedirs(run.rundir)
+            cmd = run.command(env_name, port + run.slot * stride, cpus[run.slot], taskset)
+            out = open(os.path.join(run.rundir, "out.txt"), "w")
+            print("slot %d port %d cpus %s: %s seed %d" % (run.slot, port + run.slot * stride, cpus[run.slot] if pin else "any", run.config, run.seed))
+            running[subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT, close_fds=True)] = (run, time.time())
+            out.close()
+        time.sleep(0.5)
+        for p in list(running):
+            if p.poll() is None:
+                continue
+            run, begin = running.pop(p)
+            run.returncode = p.returncode
+            run.seconds = time.time() - begin
+            free.append(run.slot)
+            print("%s seed %d ended with %d after %.1fs" % (run.config, run.seed, run.returncode, run.seconds))
+
+def number(val):
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+def summarize(runs, root):
+    """
+    One row per run and a mean and std row per configuration, written to
+    summary.tsv and summary.json under root, returns the rows
+    """
+    rows = []
+    for run in runs:
+        row = {"Config": run.config, "Seed": run.seed, "ReturnCode": run.returncode, "Seconds": run.seconds}
+        row.update(run.log())
+        rows.append(row)
+    keys = sorted(set(key for row in rows for key in row) - set(["Config", "Seed", "ReturnCode", "Seconds"]))
+    configs = []
+    for run in runs:
+        if run.config not in configs:
+            configs.append(run.config)
+    for config in configs:
+        mine = [row for row in rows if row["Config"] == config]
+        for stat, fn in (("mean", np.mean), ("std", np.std)):
+            row = {"Config": config, "Seed": stat, "ReturnCode": max(r["ReturnCode"] for r in mine)}
+            for key in ["Seconds"] + keys:
+                vals = [number(r.get(key)) for r in mine]
+                vals = [v for v in vals if v is not None]
+                if vals:
+                    row[key] = fn(vals)
+            rows.append(row)
+    header = ["Config", "Seed", "ReturnCode", "Seconds"] + keys
+    with open(os.path.join(root, "summary.tsv"), "w") as out:
+        out.write("\t".join(header) + "\n")
+        for row in rows:
+            out.write("\t".join(str(row.get(key, "")) for key in header) + "\n")
+    with open(os.path.join(root, "summary.json"), "w") as out:
+        out.write(json.dumps(rows, indent=1, sort_keys=True, default=float))
+    return rows
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('env_name', type=str)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[1])
+    parser.add_argument('--grid', type=str, action='append', default=[])
+    parser.add_argument('--jobs', '-j', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--port', type=int, default=en.PORT + 100)
+    parser.add_argument('--port_stride', type=int, default=16)
+    parser.add_argument('--no_pin', action='store_true')
+    parser.add_argument('--root', type=str, default=None)
+    # everything after -- goes to every train_pg.py run
+    argv = sys.argv[1:]
+    rest = []
+    if "--" in argv:
+        rest = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+
+    root = args.root or os.path.join("data", "experiments_" + time.strftime("%d-%m-%Y_%H-%M-%S"))
+    runs = []
+    for config, options in parsegrid(args.grid):
+        options = rest + options
+        if nenvs(options) > args.port_stride:
+            raise ValueError("%s runs %d workers, --port_stride is %d" % (config, nenvs(options), args.port_stride))
+        for seed in args.seeds:
+            runs.append(Run(config, options, seed, os.path.abspath(os.path.join(root, config, str(seed)))))
+    jobs = max(1, min(args.jobs, len(runs)))
+    launch(runs, args.env_name, jobs, args.port, args.port_stride, cpusets(jobs, multiprocessing.cpu_count()), not args.no_pin)
+    rows = summarize(runs, root)
+    header = ["Config", "Seed", "ReturnCode", "Seconds", "AverageReturn"]
+    print("\t".join(header))
+    for row in rows:
+        print("\t".join(str(row.get(key, "")) for key in header))
+
+
+if __name__ == "__main__":
+    main()
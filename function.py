@@ -1,17 +1,22 @@
+import numpy as np
+import threading
 import tensorflow as tf
 import backend as bk
 
 class Function:
-    def __init__(self):
+    def __init__(self, **backend_options):
         self._name = "go" 
         self._ops = [] 
         self._inputs = []
         self._outputs = []
         self._updateops = [] 
-        self._backend = bk.TFBackend("go")
+        self._backend = bk.TFBackend("go", **backend_options)
     def run_init(self):
         self._backend.init()
 
+    def close(self):
+        self._backend.close()
+
     def createPred(self):
         return;
 
@@ -63,29 +68,45 @@ def build_mlp(
             units=output_size,
             activation=output_activation), pool2
 
+def maskedlogits(logits, mask):
+    # the logits of registers that are not candidates are pushed far below
+    # the others, sampling and the log-prob only see candidates
+    valid = tf.logical_and(mask, tf.ones_like(logits, dtype=tf.bool))
+    return tf.where(valid, logits, tf.fill(tf.shape(logits), -1e9))
+
 class ActorFunc(Function):
-    def __init__(self):
-        Function.__init__(self)
+    def __init__(self, **backend_options):
+        Function.__init__(self, **backend_options)
+        # acting and push never run at the same time, and version counts
+        # the pushes
+        self._lock = threading.Lock()
+        self._push = None
+        self.version = 0
     
     def createPred(self, actionsize, n_layers, size):
         discrete = True
-        sy_ob_no = tf.placeholder(shape=[None, actionsize , actionsize, 1], name="ob", dtype=tf.float32)
+        # observations are fed as uint8 and only widened inside the graph
+        sy_ob_no = tf.placeholder(shape=[None, actionsize , actionsize, 1], name="ob", dtype=tf.uint8)
         if discrete:
             sy_ac_na = tf.placeholder(shape=[None], name="ac", dtype=tf.int32)
         else:
             sy_ac_na = tf.placeholder(shape=[None, ac_dim], name="ac", dtype=tf.float32)
         sy_adv_n = tf.placeholder(shape=[None], name="adv", dtype=tf.float32)
+        # candidate registers of every observation, every register is one
+        # when the mask is not fed
+        sy_mask_na = tf.placeholder_with_default(tf.ones([1, actionsize], dtype=tf.bool), shape=[None, actionsize], name="mask")
 
         if discrete:
                     # YOUR_CODE_HERE
             sy_logits_na, pool2 = build_mlp(
-                input_placeholder=sy_ob_no,
+                input_placeholder=tf.cast(sy_ob_no, tf.float32),
                 output_size=actionsize,
                 scope="build_nn",
                 n_layers=n_layers,
                 size=size,
                 activation=tf.nn.relu)
 
+            sy_logits_na = maskedlogits(sy_logits_na, sy_mask_na)
             sy_sampled_ac = tf.squeeze(tf.multinomial(sy_logits_na, 1), axis=[1]) # Hint: Use the tf.multinomial op
             sy_soft = tf.nn.softmax(sy_logits_na) # Hint: Use the tf.multinomial op
             sy_logprob_n = tf.nn.sparse_softmax_cross_entropy_with_logits(
@@ -94,7 +115,7 @@ class ActorFunc(Function):
         else:
             # YOUR_CODE_HERE
             sy_mean  = build_mlp(
-                input_placeholder=sy_ob_no,
+                input_placeholder=tf.cast(sy_ob_no, tf.float32),
                 output_size=ac_dim,
                 scope="build_nn",
                 n_layers=n_layers,
@@ -109,12 +130,62 @@ class ActorFunc(Function):
         self._inputs.append(sy_ob_no)
         self._inputs.append(sy_ac_na)
         self._inputs.append(sy_adv_n)
+        self._mask = sy_mask_na
         self._outputs.append(sy_logprob_n)
         self._ops.append(sy_soft)
         self._ops.append(sy_sampled_ac)
+        self._trunk = pool2
+        self._net = (actionsize, n_layers, size)
 
-    def run(self, params):
-        return self._backend.runAction(self._ops, self._inputs[0], params)
+    def createSnapshot(self):
+        """
+        A copy of the policy network that run acts with, so rollouts go on
+        while update trains the original. push copies the trained weights in.
+        """
+        actionsize, n_layers, size = self._net
+        sy_logits_na, _ = build_mlp(
+            input_placeholder=tf.cast(self._inputs[0], tf.float32),
+            output_size=actionsize,
+            scope="actor",
+            n_layers=n_layers,
+            size=size,
+            activation=tf.nn.relu)
+        sy_logits_na = maskedlogits(sy_logits_na, self._mask)
+        self._ops = [tf.nn.softmax(sy_logits_na), tf.squeeze(tf.multinomial(sy_logits_na, 1), axis=[1])]
+        learner = dict((v.name[len("build_nn/"):], v) for v in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope="build_nn/"))
+        actor = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope="actor/")
+        self._push = tf.group(*[v.assign(learner[v.name[len("actor/"):]]) for v in actor])
+
+    def run_init(self):
+        Function.run_init(self)
+        if self._push is not None:
+            self._backend.runPush(self._push)
+
+    def push(self):
+        """
+        Hand the weights of the last update to the actors
+        """
+        with self._lock:
+            if self._push is not None:
+                self._backend.runPush(self._push)
+            self.version += 1
+
+    def run(self, params, mask=None):
+        """
+        Distributions and sampled actions, mask holds the candidate registers
+        of every observation and the actions are always among them
+        """
+        with self._lock:
+            return self._backend.runAction(self._ops, self._inputs[0], params, self._mask, mask)
+
+    def runbatch(self, obs, max_batch=None, masks=None):
+        """
+        Act on observations from several environments with one forward pass
+        per max_batch of them, returns the stacked distributions and actions
+        """
+        step = max_batch or len(obs)
+        outs = [self.run(obs[i:i + step], None if masks is None else masks[i:i + step]) for i in range(0, len(obs), step)]
+        return np.concatenate([o[0] for o in outs]), np.concatenate([o[1] for o in outs])
     def createOptimizer(self, learning_rate):
         weighted_negative_likelihood = tf.multiply(self._outputs[0], self._inputs[2])
         loss = tf.reduce_mean(weighted_negative_likelihood)  # Loss function that we'll differentiate to get the policy gradient.
@@ -122,8 +193,30 @@ class ActorFunc(Function):
         self._updateops.append(optimizer)
         self._updateops.append(loss)
 
-    def update(self, ob_no, ac_na, adv_n):
-        return self._backend.runOptimizer(self._updateops, self._inputs[0], self._inputs[1], self._inputs[2], ob_no, ac_na, adv_n)
+    def update(self, ob_no, ac_na, adv_n, mask_na=None):
+        return self._backend.runOptimizer(self._updateops, self._inputs[0], self._inputs[1], self._inputs[2], ob_no, ac_na, adv_n, self._mask, mask_na)
+
+    def createBaseline(self, learning_rate, size=64):
+        """
+        State value head on the conv trunk of the policy, trained on
+        normalized returns
+        """
+        with tf.variable_scope("baseline"):
+            flat = tf.reshape(self._trunk, [-1, 11 * 11 * 64])
+            hidden = tf.layers.dense(inputs=flat, units=size, activation=tf.nn.relu)
+            sy_value_n = tf.squeeze(tf.layers.dense(inputs=hidden, units=1), axis=[1])
+        sy_target_n = tf.placeholder(shape=[None], name="target", dtype=tf.float32)
+        loss = tf.reduce_mean(tf.square(sy_value_n - sy_target_n))
+        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+        self._value = sy_value_n
+        self._target = sy_target_n
+        self._baselineops = [optimizer, loss]
+
+    def value(self, ob_no):
+        return self._backend.runAction(self._value, self._inputs[0], ob_no)
+
+    def updateBaseline(self, ob_no, target_n):
+        return self._backend.runBaseline(self._baselineops, self._inputs[0], self._target, ob_no, target_n)
 
 
 
@@ -17,7 +17,6 @@ A['EpRewMean']
 
 import os.path as osp, shutil, time, atexit, os, subprocess
 import pickle
-import tensorflow as tf
 
 color2num = dict(
     gray=30,
@@ -78,7 +77,10 @@ def pickle_tf_vars():
     Saves tensorflow variables
     Requires them to be initialized first, also a default session must exist
     """
-    _dict = {v.name : v.eval() for v in tf.global_variables()}
+    import tensorflow as tf
+    variables = tf.global_variables()
+    values = tf.get_default_session().run(variables)
+    _dict = {v.name : value for v, value in zip(variables, values)}
     with open(osp.join(G.output_dir, "vars.pkl"), 'wb') as f:
         pickle.dump(_dict, f)
     
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+
+Stand-in for the patched llc, it speaks the same protocol to Gplayer and
+RandomPlayer so that training and benchmarks run without LLVM. Point the
+compiler line of rlconfig at this file, or use rlconfig.mock through
+RLENS_CONFIG. The llc arguments a player passes are accepted and ignored.
+
+    simulate:  an episode allocates `steps` virtual intervals one after the
+               other among `registers` physical registers that already hold
+               `intervals` live intervals. The candidates are the registers
+               free over the whole virtual interval, the reward of one is
+               higher the tighter the interval packs against its neighbours.
+               The chosen register keeps the interval, so states depend on
+               the actions and an episode is deterministic for a seed.
+    replay:    the states of a trajectory file written by trajectory.py are
+               sent in order whatever the actions are.
+
+Like the compiler it follows the environment of the player, RLENS_PORT,
+RLENS_BINARY and RLENS_PERSISTENT for the framing, RLENS_DELTA for delta
+frames and RLENS_SHM for the shared memory ring. Options are flags or
+RLENS_MOCK_<FLAG> variables. Without a seed the simulation is seeded from
+the name of the source file, so every program of a corpus is different.
+
+"""
+
+import os
+import zlib
+import socket
+import struct
+import collections
+import numpy as np
+import protocol
+import shm
+import trajectory
+
+HOST = "127.0.0.1"
+
+
+class Simulation:
+    def __init__(self, seed=0, steps=200, intervals=1000, registers=45, maxlength=3000, span=60):
+        rng = np.random.RandomState(seed)
+        self.registers = np.arange(1, registers + 1)
+        # every register is a candidate of the first interval, which ends on
+        # the last slot, so the player learns the action set and maxlength
+        # from the first state
+        first = (maxlength - span, maxlength - 1)
+        starts = rng.randint(0, first[0] - span, intervals)
+        ends = np.minimum(starts + rng.randint(1, span, intervals), first[0] - 1)
+        self.occupancy = np.array([rng.choice(self.registers, intervals), starts, ends]).T
+        vstarts = rng.randint(0, maxlength - span, steps - 1)
+        vends = vstarts + rng.randint(1, span, steps - 1)
+        self.virtual = [first] + zip(vstarts.tolist(), vends.tolist())
+
+    def states(self):
+        """
+        Yield (slotstart, slotend, reward, vreward, occupancy, added, removed)
+        for every virtual interval that has a candidate, send back the
+        register chosen
+        """
+        added = []
+        for start, end in self.virtual:
+            reward = self.rewards(start, end)
+            if not len(reward):
+                # no register is free, the interval is spilled
+                continue
+            reg = yield start, end, reward, [], self.occupancy, added, []
+            added = [[reg, start, end]]
+            self.occupancy = np.vstack([self.occupancy, added])
+
+    def rewards(self, start, end):
+        regs, starts, ends = self.occupancy.T
+        overlap = (starts <= end) & (ends >= start)
+        free = ~np.in1d(self.registers, regs[overlap])
+        gap = np.full(len(self.registers) + 1, 100)
+        np.minimum.at(gap, regs[~overlap], np.where(ends < start, start - ends, starts - end)[~overlap])
+        reward = 100 - np.minimum(gap[self.registers], 99)
+        return np.array([self.registers[free], reward[free]]).T
+
+class Replay:
+    def __init__(self, path):
+        self._path = path
+
+    def states(self):
+        occupancy = collections.Counter()
+        for kind, iteration, payload in trajectory.readtrajectory(self._path):
+            if kind == trajectory.TEXTSTATE:
+                state = open("state.txt", "w")
+                state.write(payload)
+                state.close()
+                fields = protocol.unpackstate(protocol.statefromfile("state.txt", iteration)[protocol.HEADER.size:])
+            elif kind == trajectory.FRAMESTATE:
+                fields = protocol.unpackstate(payload)
+            elif kind == trajectory.DELTASTATE:
+                fields = protocol.unpackstate(payload, protocol.DELTA)
+            else:
+                continue
+            added = fields[5].tolist()
+            removed = []
+            if kind != trajectory.DELTASTATE:
+                occupancy = collections.Counter(map(tuple, added))
+            else:
+                removed = fields[6].tolist()
+                occupancy.update(map(tuple, added))
+                occupancy.subtract(map(tuple, removed))
+            intervals = np.array(list(occupancy.elements()), dtype=np.int64).reshape(-1, 3)
+            yield fields[1], fields[2], fields[3], fields[4], intervals, added, removed
+
+def statetext(slotstart, slotend, reward, vreward, occupancy):
+    """
+    The state.txt the compiler writes for a state
+    """
+    lines = ["3333&%d&%d\n" % (slotstart, slotend), "reward\n",
+             "".join("%d&%d&" % (reg, r) for reg, r in reward) + "\n", "vreward\n",
+             "".join("%d&%d&" % (reg, r) for reg, r in vreward) + "\n"]
+    lines.extend("%d&%d&%d&\n" % (reg, start, end) for reg, start, end in occupancy)
+    return "".join(lines)
+
+class Channel:
+    """
+    Sends states and reads actions the way the player expects them
+    """
+    def __init__(self, port, binary, persistent, delta, region=None):
+        self._port = port
+        self._binary = binary or persistent or delta or region is not None
+        self._persistent = persistent or region is not None
+        self._delta = delta
+        self._producer = shm.ShmProducer(region) if region else None
+        self._conn = None
+        self._sent = False
+
+    def connect(self):
+        if self._producer is not None:
+            return
+        if self._conn is None or not self._persistent:
+            self._conn = socket.create_connection((HOST, self._port))
+
+    def send(self, iteration, slotstart, slotend, reward, vreward, occupancy, added, removed):
+        self.connect()
+        if not self._binary:
+            state = open("state.txt", "w")
+            state.write(statetext(slotstart, slotend, reward, vreward, occupancy))
+            state.close()
+            self._conn.sendall(struct.pack("!i", iteration))
+        elif self._delta and self._sent:
+            self.write(protocol.packdelta(iteration, slotstart, slotend, reward, vreward, added, removed))
+        else:
+            self.write(protocol.packstate(iteration, slotstart, slotend, reward, vreward, occupancy))
+        self._sent = True
+        return self.recvaction()
+
+    def write(self, frame):
+        if self._producer is not None:
+            self._producer.publish(frame)
+        else:
+            self._conn.sendall(frame)
+
+    def recvaction(self):
+        if self._producer is not None:
+            return self._producer.recvaction()
+        if self._persistent:
+            kind, payload = protocol.readframe(self._conn)
+            return protocol.unpackaction(payload)
+        reg = int(self._conn.recv(1024))
+        self._conn.close()
+        return reg
+
+    def end(self):
+        self.connect()
+        if self._binary:
+            self.write(protocol.pack(protocol.END))
+        else:
+            self._conn.sendall("end")
+        if self._producer is not None:
+            self._producer.close()
+        else:
+            self._conn.close()
+
+def play(source, channel):
+    """
+    One episode, returns the number of decisions
+    """
+    states = source.states()
+    iteration = 0
+    reg = None
+    while True:
+        try:
+            state = states.send(reg) if iteration else next(states)
+        except StopIteration:
+            break
+        iteration += 1
+        reg = channel.send(iteration, *state)
+    channel.end()
+    return iteration
+
+def option(name, default, kind=int):
+    return kind(os.environ.get("RLENS_MOCK_" + name.upper(), default))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=option("seed", -1))
+    parser.add_argument('--steps', type=int, default=option("steps", 200))
+    parser.add_argument('--intervals', type=int, default=option("intervals", 1000))
+    parser.add_argument('--registers', type=int, default=option("registers", 45))
+    parser.add_argument('--maxlength', type=int, default=option("maxlength", 3000))
+    parser.add_argument('--replay', type=str, default=option("replay", "", str))
+    # the arguments players pass to llc are accepted and ignored
+    args, rest = parser.parse_known_args()
+    if args.seed < 0:
+        sources = [os.path.basename(arg) for arg in rest if arg.endswith(".ll")]
+        args.seed = zlib.crc32(sources[0]) & 0xffff if sources else 0
+    if args.replay:
+        source = Replay(args.replay)
+    else:
+        source = Simulation(args.seed, args.steps, args.intervals, args.registers, args.maxlength)
+    channel = Channel(int(os.environ.get("RLENS_PORT", 1992)), os.environ.get("RLENS_BINARY") == "1",
+                      os.environ.get("RLENS_PERSISTENT") == "1", os.environ.get("RLENS_DELTA") == "1",
+                      os.environ.get("RLENS_SHM"))
+    play(source, channel)
+
+
+if __name__ == "__main__":
+    main()
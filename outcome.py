@@ -0,0 +1,86 @@
+"""
+
+Episode outcome cache. For a given source and flags the compiler is
+deterministic, so the state after a sequence of actions is always the same.
+The cache is a prefix trie over the action indices, node 0 is the first
+state of an episode and every other node the state reached by taking an
+action in its parent, with the reward map of that state and whether the
+episode ended there.
+
+Nodes are kept flat, a list of states and a (parent, action) -> child dict,
+so that episodes thousands of steps long pickle without recursion. States
+are stored as uint8 bytes, reward maps as the dense (reward, mask) arrays of
+parse. A cache written in an older FORMAT is ignored.
+
+"""
+
+import os
+import pickle
+import numpy as np
+
+ROOT = 0
+FORMAT = 2
+
+
+class OutcomeCache:
+    def __init__(self, path=None):
+        self._path = path
+        self._nodes = []
+        self._children = {}
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            saved = pickle.load(open(path, "rb"))
+            if len(saved) == 3 and saved[0] == FORMAT:
+                _, self._nodes, self._children = saved
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def child(self, node, action):
+        """
+        The node reached by action from node, None when never taken
+        """
+        if node is None:
+            return ROOT if self._nodes else None
+        return self._children.get((node, action))
+
+    def add(self, node, action, state, reward_map, done):
+        """
+        Record the state reached by action from node, node None for the first
+        state of an episode, returns the node of that state
+        """
+        known = self.child(node, action)
+        if known is not None:
+            return known
+        data = None
+        if not done:
+            data = (np.asarray(state, dtype=np.uint8).tostring(), np.shape(state))
+            reward_map = (reward_map[0].copy(), reward_map[1].copy())
+        self._nodes.append((data, reward_map if not done else None, done))
+        if node is not None:
+            self._children[(node, action)] = len(self._nodes) - 1
+        return len(self._nodes) - 1
+
+    def state(self, node):
+        """
+        Returns (state, reward_map, done) of node
+        """
+        data, reward_map, done = self._nodes[node]
+        if done:
+            return [], [], True
+        return np.fromstring(data[0], dtype=np.uint8).reshape(data[1]), reward_map, False
+
+    def hitrate(self):
+        return self.hits / float(max(self.hits + self.misses, 1))
+
+    def save(self):
+        if self._path is None:
+            return
+        dirname = os.path.dirname(self._path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = self._path + ".%d.tmp" % os.getpid()
+        with open(tmp, "wb") as out:
+            pickle.dump((FORMAT, self._nodes, self._children), out, 2)
+        os.rename(tmp, self._path)
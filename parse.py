@@ -1,13 +1,8 @@
 from subprocess import call
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import cv2
 import numpy as np
-from skimage.transform import resize
-from shutil import copy2
 import os
 import sys
+import protocol
 
 def outputdict(reward):
   actions = {}
@@ -15,6 +10,49 @@ def outputdict(reward):
       actions[reward[i * 2]] = reward[i * 2 + 1]
   return actions
 
+def regtable(reg2idx):
+    """
+    reg2idx as an array indexed by register number, -1 for the registers
+    outside the action set. Built once per player, a table passes through.
+    """
+    if isinstance(reg2idx, np.ndarray):
+        return reg2idx
+    regs = [int(reg) for reg in reg2idx]
+    table = np.full(max(regs + [0]) + 1, -1, dtype=np.int64)
+    for reg in reg2idx:
+        table[int(reg)] = reg2idx[reg]
+    return table
+
+def lookup(table, regs):
+    regs = np.asarray(regs, dtype=np.int64)
+    inside = (regs >= 0) & (regs < len(table))
+    return np.where(inside, table[np.where(inside, regs, 0)], -1)
+
+def readpairs(line):
+    """
+    The (reg, reward) pairs of a reward line of state.txt
+    """
+    line = line.split("&")
+    return np.array(line[:len(line) / 2 * 2], dtype=np.int64).reshape(-1, 2)
+
+def candidates(reward, vreward, table, actionsize):
+    """
+    The action indices of the physical and the virtual candidates and the
+    dense reward_map of a state, a (reward, mask) pair of arrays over the
+    action indices. A virtual reward wins over a physical one.
+    """
+    res = []
+    values = np.zeros(actionsize, dtype=np.int64)
+    mask = np.zeros(actionsize, dtype=bool)
+    for pairs in (reward, vreward):
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        cols = lookup(table, pairs[:, 0])
+        keep = cols >= 0
+        values[cols[keep]] = pairs[keep, 1]
+        mask[cols[keep]] = True
+        res.append(cols[keep])
+    return res[0], res[1], (values, mask)
+
 def fileToImage(state, iteration):
     infile = open(state, "r").readlines()
     vreg =infile[0].split("&")
@@ -72,71 +110,222 @@ def fileToImage(state, iteration):
     img = img.flatten()
     return img, reward_dic, sortedr, maxmum, arr
 
-def physicalre(a, reward_dic, ratio, actionsize, slotstart, slotend, g):
-    for key in reward_dic:
-        for j in range(actionsize):
-            if j * ratio <= slotstart < (j + 1) * ratio or slotstart <= j * ratio <= slotend or j * ratio <= slotend < (j + 1) * ratio:
-                    a[j][g[str(key)]] = 255
-                    
-def vrreward(a, vreward_dic, ratio, actionsize, slotstart, slotend, g):
-    for key in vreward_dic:
-        for j in range(actionsize):
-            if j * ratio <= slotstart < (j + 1) * ratio or slotstart <= j * ratio <= slotend or j * ratio <= slotend < (j + 1) * ratio:
-                if a[j][g[str(key)]] == 255:
-                    print "wrong virtual regsiter"
-                    sys.exit(0)
-                else:
-                    a[j][g[str(key)]] = 75
-
-def getstate(state, iteration, maxlength, actionsize, reg2idx, tofile):
-    directory = "./data/log"
-    infile = open(state, "r").readlines()                  
+def timeslots(starts, ends, ratio):
+    """
+    First and last timeslot touched by each interval [start, end], a
+    timeslot j covers the slots [j * ratio, (j + 1) * ratio)
+    """
+    return starts // ratio, ends // ratio
+
+def intervalcounts(cols, starts, ends, ratio, shape):
+    """
+    Rasterize every interval of cols into a (timeslot, register) matrix at
+    once, counting the intervals that touch each cell. An interval touches
+    the timeslots of its start and end and every timeslot in between, which
+    is a difference array summed over time.
+    """
+    rows, width = shape
+    cols = np.asarray(cols, dtype=np.int64)
+    first, last = timeslots(np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64), ratio)
+    span = first <= last
+    size = (rows + 1) * width
+    opened = np.clip(first[span], 0, rows) * width + cols[span]
+    closed = np.clip(last[span] + 1, 0, rows) * width + cols[span]
+    diff = np.bincount(opened, minlength=size) - np.bincount(closed, minlength=size)
+    counts = np.cumsum(diff.reshape(rows + 1, width)[:-1], axis=0)
+    # a reversed interval only touches the timeslots of its two ends
+    first, last, cols = first[~span], last[~span], cols[~span]
+    for edge, keep in ((first, first >= 0), (last, last != first)):
+        inside = keep & (edge >= 0) & (edge < rows)
+        np.add.at(counts, (edge[inside], cols[inside]), 1)
+    return counts
+
+def intervalmask(cols, starts, ends, ratio, shape):
+    return intervalcounts(cols, starts, ends, ratio, shape) > 0
+
+def readintervals(lines, reg2idx):
+    table = regtable(reg2idx).tolist()
+    cols, bounds = [], []
+    for line in lines:
+        line = line.split("&")
+        if line[0] == "reward\n" or line[0] == "3333" or not line[0].isdigit():
+            continue
+        reg = int(line[0])
+        idx = table[reg] if reg < len(table) else -1
+        if idx < 0:
+            continue
+        n = (len(line) - 1) / 2
+        cols.extend([idx] * n)
+        bounds.extend(line[1:1 + 2 * n])
+    bounds = np.array(bounds, dtype=np.int64).reshape(-1, 2)
+    return np.array(cols, dtype=np.int64), bounds[:, 0], bounds[:, 1]
+
+def checkintervals(starts, ends, ratio, actionsize):
+    # an interval past the last timeslot is only legal when it covers them all
+    first, _ = timeslots(starts, ends, ratio)
+    if np.any((ends > actionsize * ratio) & ~((starts <= ends) & (first <= 0))):
+        print "wrong"
+        sys.exit(0)
+
+def occupy(a, cols, starts, ends, ratio):
+    checkintervals(starts, ends, ratio, a.shape[0])
+    a[intervalmask(cols, starts, ends, ratio, a.shape)] = 125
+
+def occupyloop(a, cols, starts, ends, ratio):
+    """
+    Per timeslot reference of occupy, kept for consistency checks and benchmarks
+    """
+    actionsize = a.shape[0]
+    for reg, start, end in zip(cols, starts, ends):
+        for timeslot in range(actionsize):
+            if (timeslot * ratio <= start < (timeslot + 1) * ratio) or (start <= timeslot * ratio <= end) or (timeslot * ratio <= end < (timeslot + 1) * ratio):
+                a[timeslot][reg] = 125
+            elif end > actionsize * ratio:
+                print "wrong"
+                sys.exit(0)
+
+def slotcols(a, cols, ratio, slotstart, slotend):
+    rows = np.flatnonzero(intervalmask([0], [slotstart], [slotend], ratio, (a.shape[0], 1))[:, 0])
+    return np.ix_(rows, np.asarray(cols, dtype=np.intp))
+
+def physicalre(a, cols, ratio, slotstart, slotend):
+    a[slotcols(a, cols, ratio, slotstart, slotend)] = 255
+
+def vrreward(a, cols, ratio, slotstart, slotend):
+    cells = slotcols(a, cols, ratio, slotstart, slotend)
+    if np.any(a[cells] == 255):
+        print "wrong virtual regsiter"
+        sys.exit(0)
+    a[cells] = 75
+
+def readbinary(payload, kind=protocol.STATE):
+    """
+    Decode a binary state or delta frame into the reward dicts of the text
+    format and the raw (reg, start, end) interval sections
+    """
+    fields = protocol.unpackstate(payload, kind)
+    reward_dic = dict((str(reg), str(r)) for reg, r in fields[3].tolist())
+    vreward_dic = dict((str(reg), str(r)) for reg, r in fields[4].tolist())
+    return fields[:3] + (reward_dic, vreward_dic) + fields[5:]
+
+def mapintervals(occupancy, table):
+    cols = lookup(table, occupancy[:, 0])
+    keep = cols >= 0
+    return cols[keep], occupancy[keep, 1].astype(np.int64), occupancy[keep, 2].astype(np.int64)
+
+def slotratio(maxlength, actionsize):
+    if maxlength % actionsize == 0:
+        return maxlength / actionsize
+    return (maxlength / actionsize) + 1
+
+def buildstate(slotstart, slotend, rcols, vcols, cols, starts, ends, maxlength, actionsize):
+    """
+    rcols and vcols are the action indices of the physical and virtual
+    candidates, cols, starts and ends the live intervals
+    """
+    ratio = slotratio(maxlength, actionsize)
+    # a state only holds the levels 0, 75, 125 and 255
+    a = np.zeros((actionsize, actionsize), dtype=np.uint8)
+    occupy(a, cols, starts, ends, ratio)
+    physicalre(a, rcols, ratio, slotstart, slotend)
+    vrreward(a, vcols, ratio, slotstart, slotend)
+    return a
+
+def getstate(state, iteration, maxlength, actionsize, reg2idx):
+    """
+    The state of a state.txt and its reward_map, reg2idx is a dict or the
+    table of regtable
+    """
+    table = regtable(reg2idx)
+    infile = open(state, "r").readlines()
     vreg = infile[0].split("&")
     slotstart = int(vreg[1])
-    slotend = int(vreg[2]) 
-    if maxlength % actionsize == 0:
-        ratio = maxlength / actionsize
-    else:                  
-        ratio = (maxlength / actionsize) + 1
-    rewarddata = infile[2].split("&")
-    reward_dic = outputdict(rewarddata)
-    vrewarddata = infile[4].split("&")
-    vreward_dic = outputdict(vrewarddata)
-    a = np.zeros((actionsize, actionsize))
-                           
-    for index in range(5, len(infile)):
-        line = infile[index].split("&")
-        if line[0] == "reward\n" or line[0] == "3333":
-            continue;            
-        reg = line[0]
-        if reg2idx.get(str(reg)) == None:
-            continue
-        for x in range(1, len(line), 2):
-            start = int(line[x])
-            end = int(line[x + 1])
-            for timeslot in range(actionsize):
-                if (timeslot * ratio <= start < (timeslot + 1) * ratio) or (start <= timeslot * ratio <= end) or (timeslot * ratio <= end < (timeslot + 1) * ratio):
-                    a[timeslot][reg2idx[str(reg)]] = 125
-                elif end > actionsize * ratio:
-                    print "wrong"
-                    sys.exit(0)
-    physicalre(a, reward_dic, ratio, actionsize, slotstart, slotend, reg2idx)
-    vrreward(a, vreward_dic, ratio, actionsize, slotstart, slotend, reg2idx)
-    if not os.path.exists(directory):
-        os.makedirs(directory) 
-    if tofile:
-        filename = "./data/log/filename" + str(iteration) + ".txt"
-        copy2(state, filename)
-        #name = "./data/log/filename" + str(iteration) + ".png"
-        #plt.imshow(a, interpolation='nearest')
-        #plt.xticks(np.arange(0.0, 45, 1), np.arange(0, 45, 5))
-        #plt.yticks(np.arange(0.0, 45, 1), np.arange(0, 45, 5))
-        #plt.savefig(name)
-    filename = "./data/log/filename" + str(iteration) + ".txt"
-    copy2(state, filename)
-    reward_dic.update(vreward_dic)
+    slotend = int(vreg[2])
+    rcols, vcols, reward_map = candidates(readpairs(infile[2]), readpairs(infile[4]), table, actionsize)
+    cols, starts, ends = readintervals(infile[5:], table)
+    a = buildstate(slotstart, slotend, rcols, vcols, cols, starts, ends, maxlength, actionsize)
+    #name = "./data/log/filename" + str(iteration) + ".png"
+    #plt.imshow(a, interpolation='nearest')
+    #plt.xticks(np.arange(0.0, 45, 1), np.arange(0, 45, 5))
+    #plt.yticks(np.arange(0.0, 45, 1), np.arange(0, 45, 5))
+    #plt.savefig(name)
     #s = a.flatten()
-    s = np.reshape(a, (45, 45, 1))
-    return s, reward_dic, a
+    s = np.reshape(a, (actionsize, actionsize, 1))
+    return s, reward_map, a
+
+class StateBuilder:
+    """
+    Builds the states of one episode incrementally. It keeps how many
+    intervals touch every (timeslot, register) cell and the intervals of
+    every register, so a delta frame only rasterizes the intervals that
+    changed. With check set every delta is compared with a full rebuild.
+    """
+    def __init__(self, maxlength, actionsize, check=False):
+        self._maxlength = maxlength
+        self._actionsize = actionsize
+        self._ratio = slotratio(maxlength, actionsize)
+        self._check = check
+        self.reset()
+
+    def reset(self):
+        self._counts = np.zeros((self._actionsize, self._actionsize), dtype=np.int64)
+        self._intervals = {}
+
+    def full(self, slotstart, slotend, rcols, vcols, cols, starts, ends):
+        self.reset()
+        self.add(cols, starts, ends)
+        return self.state(slotstart, slotend, rcols, vcols)
+
+    def delta(self, slotstart, slotend, rcols, vcols, added, removed):
+        self.remove(*removed)
+        self.add(*added)
+        a = self.state(slotstart, slotend, rcols, vcols)
+        if self._check:
+            cols, starts, ends = self.intervals()
+            rebuilt = buildstate(slotstart, slotend, rcols, vcols, cols, starts, ends, self._maxlength, self._actionsize)
+            assert (rebuilt == a).all(), "Incremental state differs from the full rebuild"
+        return a
 
+    def add(self, cols, starts, ends):
+        checkintervals(starts, ends, self._ratio, self._actionsize)
+        self._counts += intervalcounts(cols, starts, ends, self._ratio, self._counts.shape)
+        for interval in zip(cols.tolist(), starts.tolist(), ends.tolist()):
+            self._intervals[interval] = self._intervals.get(interval, 0) + 1
 
+    def remove(self, cols, starts, ends):
+        for interval in zip(cols.tolist(), starts.tolist(), ends.tolist()):
+            assert self._intervals.get(interval, 0) > 0, "Removing unknown interval %s" % (interval,)
+            self._intervals[interval] -= 1
+            if self._intervals[interval] == 0:
+                del self._intervals[interval]
+        self._counts -= intervalcounts(cols, starts, ends, self._ratio, self._counts.shape)
+
+    def intervals(self):
+        items = [interval for interval, n in self._intervals.items() for _ in range(n)]
+        arr = np.array(items, dtype=np.int64).reshape(-1, 3)
+        return arr[:, 0], arr[:, 1], arr[:, 2]
+
+    def state(self, slotstart, slotend, rcols, vcols):
+        a = np.where(self._counts > 0, 125, 0).astype(np.uint8)
+        physicalre(a, rcols, self._ratio, slotstart, slotend)
+        vrreward(a, vcols, self._ratio, slotstart, slotend)
+        return a
+
+def getstatebinary(payload, maxlength, actionsize, reg2idx, kind=protocol.STATE, builder=None):
+    """
+    getstate for a binary state or delta frame, also returns the iteration
+    the compiler stamped on it. Deltas need the builder of the episode.
+    """
+    table = regtable(reg2idx)
+    fields = protocol.unpackstate(payload, kind)
+    iteration, slotstart, slotend = fields[:3]
+    rcols, vcols, reward_map = candidates(fields[3], fields[4], table, actionsize)
+    sections = [mapintervals(section, table) for section in fields[5:]]
+    if kind == protocol.DELTA:
+        a = builder.delta(slotstart, slotend, rcols, vcols, sections[0], sections[1])
+    elif builder is not None:
+        a = builder.full(slotstart, slotend, rcols, vcols, *sections[0])
+    else:
+        a = buildstate(slotstart, slotend, rcols, vcols, sections[0][0], sections[0][1], sections[0][2], maxlength, actionsize)
+    s = np.reshape(a, (actionsize, actionsize, 1))
+    return s, reward_map, a, iteration
@@ -1,5 +1,10 @@
 import numpy as np
 import time
+import threading
+import traceback
+import Queue
+import advantage
+import timing
 
 class Model:
     def __init__(self, n_iter):
@@ -9,7 +14,7 @@ def pathlength(path):
     return len(path["reward"])
 
 class PolicyGradient(Model):
-    def __init__(self, n_iter, env, act, animate, min_times, max_path_length, reward_to_go):
+    def __init__(self, n_iter, env, act, animate, min_times, max_path_length, reward_to_go, max_batch=None, max_wait=0.0, recorder=None, normalize_advantages=False, nn_baseline=False, gae_lambda=None, checkpointer=None, overlap=False, max_lag=1):
         Model.__init__(self, n_iter)
         self._env = env
         self._act = act
@@ -17,77 +22,91 @@ class PolicyGradient(Model):
         self._min_timesteps = min_times
         self._max_pathlength = max_path_length
         self._reward_to_go = reward_to_go
+        # batched inference over a VecGplayer: at most max_batch observations
+        # per forward pass, waiting up to max_wait seconds to fill it
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._passes = 0
+        self._decisions = 0
+        # dataset.DatasetWriter that keeps every path for offline training
+        self._recorder = recorder
+        # the baseline is the value head of ActorFunc.createBaseline,
+        # gae_lambda None subtracts it from the returns instead of GAE
+        self._normalize_advantages = normalize_advantages
+        self._nn_baseline = nn_baseline
+        self._gae_lambda = gae_lambda
+        # checkpoint.Checkpointer, pickle_tf_vars every iteration without one
+        self._checkpointer = checkpointer
+        # with overlap the paths of the next iterations are collected while
+        # update runs. Every path keeps the act.version it was sampled with,
+        # batch j only starts once version is at least j - max_lag.
+        self._overlap = overlap
+        self._max_lag = max_lag
+        self._turns = threading.Semaphore(max_lag + 1)
 
     def run(self, gamma, logz, start):
         total_timesteps = 0
+        batches = self.batches()
         for itr in range(self._iter):
             print("********** Iteration %i ************"%itr)
+            itr_start = time.time()
 
             # Collect paths until we have enough timesteps
-            timesteps_this_batch = 0
-            paths = []
-            while True:
-                ob, reward_map = self._env.reset()
-                #ob = env.reset()
-                obs, acs, rewards = [], [], []
-                animate_this_episode=(len(paths)==0 and (itr % 10 == 0) and self._animate)
-                steps = 0
-                valid = True 
-                while True:
-                    if animate_this_episode:
-                        env.render()
-                        time.sleep(0.05)
-                    obs.append(ob)
-                    [distribution], acc = self._act.run(ob[None]) 
-                    #[distri, acc] = act.run(ob[None])
-                    #ac, valid = en.among(distri, acc[0], valid)
-                    rew, ac, valid = self._env.among(distribution, reward_map, acc[0], valid)
-                    acs.append(ac)
-                    if valid == False:
-                        steps += 1
-                        rewards.append(rew)
-                        continue
-
-                    ob, done, reward_map = self._env.step(ac)
-                    #ob, rew, done, _ = env.step(ac)
-                    rewards.append(rew)
-                    steps += 1
-                    if done or steps > self._max_pathlength:
-                        break
-                path = {"observation" : np.array(obs), 
-                    "reward" : np.array(rewards), 
-                    "action" : np.array(acs)}
-                paths.append(path)
-                timesteps_this_batch += pathlength(path)
-                print str(timesteps_this_batch) + "go"
-                if timesteps_this_batch > self._min_timesteps:
-                    break
+            paths, timesteps_this_batch, latency, phases, sampled = next(batches)
+            waited = time.time() - itr_start
+            # the phases of the batch, whichever thread sampled it
+            timing.merge(*phases)
+            lags = [self._act.version - path["version"] for path in paths]
             total_timesteps += timesteps_this_batch
+            if self._recorder is not None:
+                for path in paths:
+                    self._recorder.addpath(path)
 
             # Build arrays for observation, action for the policy gradient update by concatenating 
             # across paths
             ob_no = np.concatenate([path["observation"] for path in paths])
+            # keep one copy of the observations, the paths see slices of it
+            begin = 0
+            for path in paths:
+                path["observation"] = ob_no[begin:begin + pathlength(path)]
+                begin += pathlength(path)
             ac_na = np.concatenate([path["action"] for path in paths])
+            mask_na = np.concatenate([path["mask"] for path in paths])
+            re_n = np.concatenate([path["reward"] for path in paths])
+            lengths = [pathlength(path) for path in paths]
 
-            # YOUR_CODE_HERE
-                                                                        
-                                                                        
-            q_n = []
-            if self._reward_to_go:
-                q_n = np.concatenate([self.discount_rewards_to_go(path["reward"], gamma) for path in paths])
-            else:
-                q_n = np.concatenate([[self.sum_discount_rewards(path["reward"], gamma)] * pathlength(path) for path in paths])
-        
-            adv_n = q_n.copy()
+            with timing.phase("Returns"):
+                if self._reward_to_go:
+                    q_n = advantage.rewardstogo(re_n, lengths, gamma)
+                else:
+                    q_n = advantage.episodereturns(re_n, lengths, gamma)
 
+                if self._nn_baseline:
+                    # the value head predicts normalized returns
+                    b_n = self._act.value(ob_no) * q_n.std() + q_n.mean()
+                    if self._gae_lambda is None:
+                        adv_n = q_n - b_n
+                    else:
+                        adv_n = advantage.gae(re_n, b_n, lengths, gamma, self._gae_lambda)
+                else:
+                    adv_n = q_n.copy()
+                if self._normalize_advantages:
+                    adv_n = advantage.normalize(adv_n)
 
-            _, loss_value = self._act.update(ob_no, ac_na, adv_n)
+            with timing.phase("Update"):
+                _, loss_value = self._act.update(ob_no, ac_na, adv_n, mask_na)
+                if self._nn_baseline:
+                    _, baseline_loss = self._act.updateBaseline(ob_no, advantage.normalize(q_n))
+                self._act.push()
+                self._turns.release()
             returns = [path["reward"].sum() for path in paths]
             ep_lengths = [pathlength(path) for path in paths]
             logz.log_tabular("Time", time.time() - start)
             logz.log_tabular("Iteration", itr)
             logz.log_tabular("AverageReturn", np.mean(returns))
             logz.log_tabular("Loss", loss_value)
+            if self._nn_baseline:
+                logz.log_tabular("BaselineLoss", baseline_loss)
             logz.log_tabular("StdReturn", np.std(returns))
             logz.log_tabular("MaxReturn", np.max(returns))
             logz.log_tabular("MinReturn", np.min(returns))
@@ -95,17 +114,198 @@ class PolicyGradient(Model):
             logz.log_tabular("EpLenStd", np.std(ep_lengths))
             logz.log_tabular("TimestepsThisBatch", timesteps_this_batch)
             logz.log_tabular("TimestepsSoFar", total_timesteps)
+            # updates between the weights a path was sampled with and the
+            # ones it trained
+            logz.log_tabular("PolicyLag", np.mean(lags))
+            logz.log_tabular("PolicyLagMax", np.max(lags))
+            logz.log_tabular("RolloutWait", waited)
+            # what the batch takes as uint8, and would take as float64 states
+            logz.log_tabular("ObservationMB", ob_no.nbytes / 1048576.0)
+            logz.log_tabular("ObservationMBFloat64", ob_no.size * 8 / 1048576.0)
+            for key, val in sorted(latency.items()):
+                logz.log_tabular(key, val)
+            timing.log(logz, timesteps_this_batch, sampled)
+            if self._checkpointer is not None:
+                self._checkpointer.save(itr, logz)
             logz.dump_tabular()
-            logz.pickle_tf_vars()
+            if self._checkpointer is None:
+                logz.pickle_tf_vars()
     
-    def discount_rewards_to_go(self, rewards, gamma):
-        res = [] 
-        future_reward = 0
-        for r in reversed(rewards):
-            future_reward = future_reward * gamma + r
-            res.append(future_reward)
-        return res[::-1]
+    def sample(self, itr):
+        """
+        One batch, the latency of the environment while collecting it, the
+        timing.collect of the phases it took and its seconds. The workers
+        of a VecGplayer are idle between batches, their stats are gathered
+        then.
+        """
+        begin = time.time()
+        if hasattr(self._env, "poll"):
+            paths, timesteps_this_batch = self.samplevec()
+        else:
+            paths, timesteps_this_batch = self.samplepaths(itr)
+        if hasattr(self._env, "timing"):
+            self._env.timing()
+        latency = self._env.latency()
+        if hasattr(self._env, "poll"):
+            latency["InferenceBatchMean"] = self._decisions / float(max(self._passes, 1))
+            self._passes = 0
+            self._decisions = 0
+        return paths, timesteps_this_batch, latency, timing.collect(), time.time() - begin
+
+    def batches(self):
+        """
+        Yield what sample returns for every iteration. With
+        overlap they come from a thread that keeps sampling while the caller
+        updates.
+        """
+        if not self._overlap:
+            for itr in range(self._iter):
+                yield self.sample(itr)
+            return
+        queue = Queue.Queue()
+        def collect():
+            try:
+                for itr in range(self._iter):
+                    self._turns.acquire()
+                    queue.put(self.sample(itr))
+            except Exception as e:
+                traceback.print_exc()
+                queue.put(e)
+        collector = threading.Thread(target=collect)
+        collector.daemon = True
+        collector.start()
+        for itr in range(self._iter):
+            batch = queue.get()
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+        collector.join()
 
+    def samplepaths(self, itr):
+        timesteps_this_batch = 0
+        paths = []
+        while True:
+            ob, reward_map = self._env.reset()
+            #ob = env.reset()
+            version = self._act.version
+            obs, acs, rewards, masks = [], [], [], []
+            animate_this_episode=(len(paths)==0 and (itr % 10 == 0) and self._animate)
+            steps = 0
+            while True:
+                if animate_this_episode:
+                    env.render()
+                    time.sleep(0.05)
+                obs.append(ob)
+                mask = self._env.mask(reward_map)
+                masks.append(mask)
+                # the mask keeps the sample among the candidate registers
+                with timing.phase("Act"):
+                    [distribution], acc = self._act.run(ob[None], mask[None])
+                rew, ac, _ = self._env.among(distribution, reward_map, acc[0], True)
+                acs.append(ac)
+                ob, done, reward_map = self._env.step(ac)
+                #ob, rew, done, _ = env.step(ac)
+                rewards.append(rew)
+                steps += 1
+                if done or steps > self._max_pathlength:
+                    break
+            path = {"observation" : np.array(obs, dtype=np.uint8), 
+                "reward" : np.array(rewards), 
+                "action" : np.array(acs),
+                "mask" : np.array(masks),
+                "version" : version}
+            paths.append(path)
+            timesteps_this_batch += pathlength(path)
+            print str(timesteps_this_batch) + "go"
+            if timesteps_this_batch > self._min_timesteps:
+                break
+        return paths, timesteps_this_batch
+
+    def samplevec(self):
+        """
+        Collect paths from every worker of a VecGplayer. The states that are
+        ready are acted on together with one forward pass, episodes still
+        running when the batch is full are finished and kept.
+        """
+        env = self._env
+        max_batch = self._max_batch or env.nenvs
+        timesteps_this_batch = 0
+        paths = []
+        episodes = {}
+        versions = {}
+        for i in range(env.nenvs):
+            env.reset_async(i)
+            versions[i] = self._act.version
+        while True:
+            ready = env.poll()
+            if not ready:
+                break
+            deadline = time.time() + self._max_wait
+            while len(ready) < max_batch and time.time() < deadline:
+                more = env.poll(timeout=deadline - time.time())
+                if not more:
+                    break
+                ready.extend(more)
+            todo = []
+            for i, ob, done, reward_map in ready:
+                obs, acs, rewards, masks = episodes.setdefault(i, ([], [], [], []))
+                if not done and len(rewards) <= self._max_pathlength:
+                    todo.append((i, ob, reward_map))
+                    continue
+                if not done:
+                    env.abort(i)
+                path = {"observation" : np.array(obs, dtype=np.uint8),
+                    "reward" : np.array(rewards),
+                    "action" : np.array(acs),
+                    "mask" : np.array(masks),
+                    "version" : versions[i]}
+                paths.append(path)
+                del episodes[i]
+                timesteps_this_batch += pathlength(path)
+                print str(timesteps_this_batch) + "go"
+                if timesteps_this_batch <= self._min_timesteps:
+                    env.reset_async(i)
+                    versions[i] = self._act.version
+            if todo:
+                candidates = np.array([env.mask(reward_map) for _, _, reward_map in todo])
+                with timing.phase("Act"):
+                    distributions, acc = self._act.runbatch(np.array([t[1] for t in todo]), max_batch, candidates)
+                self._passes += (len(todo) + max_batch - 1) / max_batch
+                self._decisions += len(todo)
+                for (i, ob, reward_map), mask, distribution, ac in zip(todo, candidates, distributions, acc):
+                    obs, acs, rewards, masks = episodes[i]
+                    obs.append(ob)
+                    masks.append(mask)
+                    rew, ac, _ = env.among(distribution, reward_map, ac, True)
+                    acs.append(ac)
+                    rewards.append(rew)
+                    env.step_async(i, ac)
+        return paths, timesteps_this_batch
 
-    def sum_discount_rewards(self, rewards, gamma):
-        return sum((gamma**i) * rewards[i] for i in range(len(rewards)))
+    def evaluate(self, episodes, env=None):
+        """
+        Greedy rollouts of the current policy on env, a single player, the
+        training env by default. Identical episodes are answered by a
+        CachedGplayer without the compiler. Returns a summary dict, logz
+        does not take new keys after the first iteration.
+        """
+        env = env or self._env
+        returns = []
+        for _ in range(episodes):
+            ob, reward_map = env.reset()
+            total, steps, done = 0, 0, False
+            while not done and steps <= self._max_pathlength:
+                [distribution], _ = self._act.run(ob[None], env.mask(reward_map)[None])
+                rew, ac = env.greedy(distribution, reward_map)
+                total += rew
+                steps += 1
+                ob, done, reward_map = env.step(ac)
+            if not done:
+                env.abort()
+            returns.append(total)
+        res = {"EvalEpisodes": episodes, "EvalAverageReturn": np.mean(returns), "EvalMaxReturn": np.max(returns)}
+        for key, val in env.latency().items():
+            res["Eval" + key] = val
+        for key in sorted(res):
+            print("%s %s" % (key, res[key]))
+        return res
@@ -0,0 +1,138 @@
+"""
+
+Binary framing of the compiler state, an alternative to the state.txt
+round trip. Every frame is a fixed header followed by its payload
+
+    header:  magic "RL", version, kind, payload length     (!2sBBI)
+    state:   iteration, slotstart, slotend,
+             reward pairs, vreward pairs, occupancy intervals  (!iiiIII)
+             int32 (reg, reward) * reward pairs
+             int32 (reg, reward) * vreward pairs
+             int32 (reg, start, end) * occupancy intervals
+    delta:   iteration, slotstart, slotend, reward pairs,
+             vreward pairs, added and removed intervals         (!iiiIIII)
+             sections as in state, the removed intervals last
+    action:  physical register                                 (!i)
+    end:     empty, the compiler finished the episode
+
+A delta only carries the intervals that changed since the previous state
+of the episode, the first state of an episode is always a full state.
+
+All integers are big endian like the iteration number the compiler sent
+before, the sections are decoded in place with np.frombuffer.
+
+"""
+
+import struct
+import numpy as np
+
+MAGIC = "RL"
+VERSION = 1
+
+STATE = 1
+ACTION = 2
+END = 3
+DELTA = 4
+
+HEADER = struct.Struct("!2sBBI")
+STATEHEAD = struct.Struct("!iiiIII")
+DELTAHEAD = struct.Struct("!iiiIIII")
+ACTIONBODY = struct.Struct("!i")
+INT32 = np.dtype(">i4")
+
+
+class ProtocolError(Exception):
+    pass
+
+def pack(kind, payload=""):
+    return HEADER.pack(MAGIC, VERSION, kind, len(payload)) + payload
+
+def unpackheader(data):
+    magic, version, kind, length = HEADER.unpack(str(data[:HEADER.size]))
+    if magic != MAGIC:
+        raise ProtocolError("bad magic %r" % magic)
+    if version != VERSION:
+        raise ProtocolError("unsupported version %d, expected %d" % (version, VERSION))
+    return kind, length
+
+def packstate(iteration, slotstart, slotend, reward, vreward, occupancy):
+    """
+    reward and vreward are (reg, reward) pairs, occupancy is (reg, start, end)
+    intervals, anything np.asarray can reshape
+    """
+    reward = np.asarray(reward, dtype=INT32).reshape(-1, 2)
+    vreward = np.asarray(vreward, dtype=INT32).reshape(-1, 2)
+    occupancy = np.asarray(occupancy, dtype=INT32).reshape(-1, 3)
+    head = STATEHEAD.pack(iteration, slotstart, slotend, len(reward), len(vreward), len(occupancy))
+    return pack(STATE, head + reward.tostring() + vreward.tostring() + occupancy.tostring())
+
+def packdelta(iteration, slotstart, slotend, reward, vreward, added, removed):
+    reward = np.asarray(reward, dtype=INT32).reshape(-1, 2)
+    vreward = np.asarray(vreward, dtype=INT32).reshape(-1, 2)
+    added = np.asarray(added, dtype=INT32).reshape(-1, 3)
+    removed = np.asarray(removed, dtype=INT32).reshape(-1, 3)
+    head = DELTAHEAD.pack(iteration, slotstart, slotend, len(reward), len(vreward), len(added), len(removed))
+    return pack(DELTA, head + reward.tostring() + vreward.tostring() + added.tostring() + removed.tostring())
+
+def packaction(reg):
+    return pack(ACTION, ACTIONBODY.pack(int(reg)))
+
+def unpackaction(payload):
+    return ACTIONBODY.unpack(str(payload))[0]
+
+def unpackstate(payload, kind=STATE):
+    """
+    Decode a state or delta payload without copying it, returns iteration,
+    slotstart, slotend and the sections as views into payload
+    """
+    head = STATEHEAD if kind == STATE else DELTAHEAD
+    fields = head.unpack(str(payload[:head.size]))
+    widths = (2, 2, 3, 3)[:len(fields) - 3]
+    counts = fields[3:]
+    if len(payload) != head.size + INT32.itemsize * sum(c * w for c, w in zip(counts, widths)):
+        raise ProtocolError("state payload of %d bytes does not match its header" % len(payload))
+    offset = head.size
+    sections = []
+    for count, width in zip(counts, widths):
+        section = np.frombuffer(payload, dtype=INT32, count=count * width, offset=offset)
+        sections.append(section.reshape(count, width))
+        offset += section.nbytes
+    return tuple(fields[:3]) + tuple(sections)
+
+def recvinto(conn, view):
+    got = 0
+    while got < len(view):
+        n = conn.recv_into(view[got:], len(view) - got)
+        if n == 0:
+            raise ProtocolError("connection closed inside a frame")
+        got += n
+
+def readframe(conn):
+    """
+    Read exactly one frame from conn, returns its kind and payload
+    """
+    header = bytearray(HEADER.size)
+    recvinto(conn, memoryview(header))
+    kind, length = unpackheader(header)
+    payload = bytearray(length)
+    recvinto(conn, memoryview(payload))
+    return kind, payload
+
+def statefromfile(state, iteration):
+    """
+    Encode a state.txt written by the compiler as a state frame
+    """
+    infile = open(state, "r").readlines()
+    vreg = infile[0].split("&")
+    sections = []
+    for line in (infile[2], infile[4]):
+        line = line.split("&")
+        sections.append([int(x) for x in line[:len(line) / 2 * 2]])
+    occupancy = []
+    for line in infile[5:]:
+        line = line.split("&")
+        if line[0] == "reward\n" or line[0] == "3333" or line[0].strip() == "":
+            continue
+        for x in range(1, len(line) - 1, 2):
+            occupancy.extend([int(line[0]), int(line[x]), int(line[x + 1])])
+    return packstate(iteration, int(vreg[1]), int(vreg[2]), sections[0], sections[1], occupancy)
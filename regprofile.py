@@ -0,0 +1,88 @@
+"""
+
+Register discovery cache. Before training, a RandomPlayer episode is run to
+learn which registers the allocator offers and the longest slot index, the
+result is kept in <cachedir>/<key>.json so that later runs, and experiments
+started side by side, skip that compile.
+
+The key is the sha1 of the compiler binary, the source file and the
+compiler arguments, any change to them makes a new profile.
+
+"""
+
+import os
+import json
+import hashlib
+
+CACHEDIR = "./data/profile"
+
+
+def profilekey(llc, src, args):
+    h = hashlib.sha1()
+    for name in (llc, src):
+        f = open(name, "rb")
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+        f.close()
+        h.update("\0")
+    h.update("\0".join(args))
+    return h.hexdigest()
+
+def profilepath(cachedir, key):
+    return os.path.join(cachedir, key + ".json")
+
+def loadprofile(cachedir, key):
+    """
+    Returns (actionset, maxlength) of a cached profile, None when missing
+    """
+    name = profilepath(cachedir, key)
+    if not os.path.exists(name):
+        return None
+    profile = json.load(open(name))
+    # json gives unicode, the players key registers by str
+    return set(str(reg) for reg in profile["actionset"]), profile["maxlength"]
+
+def saveprofile(cachedir, key, actionset, maxlength):
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    # written under a name of its own and renamed, a concurrent run reads
+    # either nothing or the whole profile
+    tmp = profilepath(cachedir, key) + ".%d.tmp" % os.getpid()
+    with open(tmp, "w") as out:
+        out.write(json.dumps({"actionset": sorted(actionset), "maxlength": maxlength}))
+    os.rename(tmp, profilepath(cachedir, key))
+
+def invalidate(cachedir, key=None):
+    """
+    Drop the profile of key, or every cached profile
+    """
+    if not os.path.exists(cachedir):
+        return
+    for name in os.listdir(cachedir):
+        if key is None or name == key + ".json":
+            os.unlink(os.path.join(cachedir, name))
+
+def playerkey(player):
+    # the output file does not change what the allocator does
+    args = [arg for arg in player.command()[1:] if arg not in (player._src, player._target)]
+    return profilekey(player._llc, player._src, args)
+
+def discover(player, cachedir=CACHEDIR, refresh=False):
+    """
+    Action set and max slot length for the compiler of player, a
+    RandomPlayer, which only runs when the profile is not cached
+    """
+    key = playerkey(player)
+    if refresh:
+        invalidate(cachedir, key)
+    profile = loadprofile(cachedir, key)
+    if profile is not None:
+        print "register profile " + key + " from cache"
+        return profile
+    player.reset()
+    actionset, maxlength = player.step()
+    saveprofile(cachedir, key, actionset, maxlength)
+    return actionset, maxlength
@@ -0,0 +1,191 @@
+"""
+
+Shared memory transport between the compiler and Gplayer, for training on
+the same machine. The trainer creates a region file (under /dev/shm when it
+exists) that both sides mmap
+
+    layout:    magic "RLSM", version, slots, slot size           (=4sIII)
+    counters:  head, tail, action sequence, action               (=qqqi)
+    slots:     from DATA on, a ring of slots holding one protocol frame each
+
+The producer writes a frame into slot head % slots and bumps head, the
+consumer reads slot tail % slots in place and bumps tail, so the state is
+written once and decoded as numpy views into the region. Actions are
+written back into the counters. Each counter has one writer, head the
+producer, the others the consumer, and a side only stores its own fields,
+so the ring holds more than one frame without either side undoing the
+other. Each side is woken up through a FIFO next
+to the region, <path>.state for the consumer and <path>.action for the
+producer, carrying one byte per message.
+
+Run this file as a script for a local producer stand-in that plays
+synthetic episodes against a Gplayer without LLVM.
+
+"""
+
+import os
+import mmap
+import select
+import struct
+import tempfile
+import numpy as np
+import protocol
+
+MAGIC = "RLSM"
+VERSION = 1
+LAYOUT = struct.Struct("=4sIII")
+COUNTERS = struct.Struct("=qqqi")
+# (offset, format) of every counter in the region
+HEAD = (LAYOUT.size, struct.Struct("=q"))
+TAIL = (LAYOUT.size + 8, struct.Struct("=q"))
+ACTSEQ = (LAYOUT.size + 16, struct.Struct("=q"))
+ACTION = (LAYOUT.size + 24, struct.Struct("=i"))
+DATA = 64
+
+
+def regionpath(port):
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "rlens-%d" % port)
+
+class ShmRegion:
+    def __init__(self, path):
+        self._path = path
+        f = open(path, "r+b")
+        self._mm = mmap.mmap(f.fileno(), 0)
+        f.close()
+        magic, version, self._nslots, self._slotsize = LAYOUT.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise protocol.ProtocolError("%s is not a version %d region" % (path, VERSION))
+        # O_RDWR keeps opening a FIFO from blocking on the other side
+        self._statefd = os.open(path + ".state", os.O_RDWR)
+        self._actionfd = os.open(path + ".action", os.O_RDWR)
+
+    def counters(self):
+        return COUNTERS.unpack_from(self._mm, LAYOUT.size)
+
+    def setcounters(self, head, tail, actseq, action):
+        COUNTERS.pack_into(self._mm, LAYOUT.size, head, tail, actseq, action)
+
+    def setcounter(self, counter, value):
+        offset, fmt = counter
+        fmt.pack_into(self._mm, offset, value)
+
+    def slot(self, seq):
+        return DATA + (seq % self._nslots) * self._slotsize
+
+    def wait(self, fd, alive=None):
+        # wake up now and then to notice a peer that went away
+        while not select.select([fd], [], [], 1.0)[0]:
+            if alive is not None and not alive():
+                raise protocol.ProtocolError("shared memory peer exited")
+        os.read(fd, 1)
+
+    def close(self):
+        os.close(self._statefd)
+        os.close(self._actionfd)
+        self._mm.close()
+
+class ShmChannel(ShmRegion):
+    """
+    Consumer side used by Gplayer, it creates the region and reads states
+    in place
+    """
+    def __init__(self, path, nslots=4, slotsize=1 << 20):
+        f = open(path, "w+b")
+        f.truncate(DATA + nslots * slotsize)
+        f.write(LAYOUT.pack(MAGIC, VERSION, nslots, slotsize))
+        f.close()
+        for fifo in (path + ".state", path + ".action"):
+            if os.path.exists(fifo):
+                os.unlink(fifo)
+            os.mkfifo(fifo)
+        ShmRegion.__init__(self, path)
+        self._alive = None
+
+    def reset(self):
+        """
+        Empty the ring for a new episode, before the producer is started
+        """
+        self.setcounters(0, 0, 0, 0)
+        while select.select([self._statefd], [], [], 0)[0]:
+            os.read(self._statefd, 4096)
+        self._alive = None
+
+    def watch(self, process):
+        """
+        Give up waiting for a frame once the Popen process has exited
+        """
+        self._alive = lambda: process.poll() is None
+
+    def readframe(self):
+        """
+        Wait for the next frame, returns its kind and its payload as a
+        buffer into the region, valid until the producer wraps around
+        """
+        self.wait(self._statefd, self._alive)
+        tail = self.counters()[1]
+        offset = self.slot(tail)
+        kind, length = protocol.unpackheader(buffer(self._mm, offset, protocol.HEADER.size))
+        payload = buffer(self._mm, offset + protocol.HEADER.size, length)
+        self.setcounter(TAIL, tail + 1)
+        return kind, payload
+
+    def sendaction(self, reg):
+        # the action before its sequence number
+        self.setcounter(ACTION, int(reg))
+        self.setcounter(ACTSEQ, self.counters()[2] + 1)
+        os.write(self._actionfd, "a")
+
+    def unlink(self):
+        self.close()
+        for name in (self._path, self._path + ".state", self._path + ".action"):
+            if os.path.exists(name):
+                os.unlink(name)
+
+class ShmProducer(ShmRegion):
+    """
+    Producer side, what the compiler does, opened on the region of
+    RLENS_SHM
+    """
+    def publish(self, frame):
+        head, tail = self.counters()[:2]
+        if len(frame) > self._slotsize:
+            raise protocol.ProtocolError("frame of %d bytes does not fit a %d byte slot" % (len(frame), self._slotsize))
+        if head - tail >= self._nslots:
+            raise protocol.ProtocolError("ring is full")
+        offset = self.slot(head)
+        self._mm[offset:offset + len(frame)] = frame
+        self.setcounter(HEAD, head + 1)
+        os.write(self._statefd, "s")
+
+    def recvaction(self):
+        self.wait(self._actionfd)
+        return self.counters()[3]
+
+def produce(path, steps, count, actionsize=45, maxlength=3000):
+    """
+    Play one synthetic episode of steps decisions over count intervals
+    """
+    producer = ShmProducer(path)
+    regs = np.arange(actionsize)
+    for iteration in range(1, steps + 1):
+        starts = np.random.randint(0, maxlength, count)
+        occupancy = np.array([np.random.randint(0, actionsize, count), starts, np.minimum(starts + 40, maxlength - 1)]).T
+        reward = np.array([regs[:4], np.arange(4)]).T
+        producer.publish(protocol.packstate(iteration, 0, 10, reward, [], occupancy))
+        producer.recvaction()
+    producer.publish(protocol.pack(protocol.END))
+    producer.close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--intervals', type=int, default=1000)
+    # the arguments Gplayer passes to llc are accepted and ignored
+    args, _ = parser.parse_known_args()
+    produce(os.environ["RLENS_SHM"], args.steps, args.intervals)
+
+
+if __name__ == "__main__":
+    main()
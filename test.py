@@ -1,8 +1,10 @@
 import parse
+import regprofile
+import protocol
+import shm
+import tempfile
 from subprocess import call
-import cv2
 import numpy as np
-from skimage.transform import resize
 from shutil import copy2
 import os
 
@@ -252,6 +254,92 @@ def test_virtual_overlap(a):
                         if a[time][reg] != 125:
                             print "occu falut"
 
+def test_occupy():
+    ratio = 67
+    cols = np.random.randint(0, 45, 1000)
+    starts = np.random.randint(0, 45 * ratio, 1000)
+    ends = np.minimum(starts + np.random.randint(-ratio, 10 * ratio, 1000), 45 * ratio - 1)
+    a = np.zeros((45, 45))
+    b = np.zeros((45, 45))
+    parse.occupyloop(a, cols, starts, ends, ratio)
+    parse.occupy(b, cols, starts, ends, ratio)
+    if (a != b).any():
+        print "occupy falut"
+
+def test_incremental():
+    builder = parse.StateBuilder(3000, 45, check=True)
+    rcols, vcols = np.array([1]), np.array([], dtype=np.int64)
+    live = [list(x) for x in zip(np.random.randint(0, 45, 200), np.random.randint(0, 2000, 200), np.random.randint(2000, 2999, 200))]
+    occ = np.array(live, dtype=np.int64)
+    builder.full(0, 10, rcols, vcols, occ[:, 0], occ[:, 1], occ[:, 2])
+    for step in range(50):
+        removed = [live.pop(np.random.randint(len(live)))]
+        added = [[np.random.randint(45), np.random.randint(0, 2999), np.random.randint(0, 2999)]]
+        live.extend(added)
+        sections = [np.array(x, dtype=np.int64).reshape(-1, 3) for x in (added, removed)]
+        a = builder.delta(0, 10, rcols, vcols, *[(x[:, 0], x[:, 1], x[:, 2]) for x in sections])
+        occ = np.array(live, dtype=np.int64)
+        if (a != parse.buildstate(0, 10, rcols, vcols, occ[:, 0], occ[:, 1], occ[:, 2], 3000, 45)).any():
+            print "incremental falut"
+
+def test_shm():
+    path = os.path.join(tempfile.gettempdir(), "rlens-test-%d" % os.getpid())
+    channel = shm.ShmChannel(path, nslots=4, slotsize=1 << 16)
+    channel.reset()
+    producer = shm.ShmProducer(path)
+    frames = [protocol.pack(protocol.STATE, "state%d" % i) for i in range(6)]
+    for frame in frames[:4]:
+        producer.publish(frame)
+    try:
+        producer.publish(frames[4])
+        print "shm falut"
+    except protocol.ProtocolError:
+        pass
+    # the consumer takes frames while the producer refills the ring
+    for i in range(6):
+        kind, payload = channel.readframe()
+        if kind != protocol.STATE or str(payload) != "state%d" % i:
+            print "shm falut"
+        if i < 2:
+            producer.publish(frames[4 + i])
+        channel.sendaction(37 + i)
+        if producer.recvaction() != 37 + i:
+            print "shm falut"
+    if channel.counters() != (6, 6, 6, 42):
+        print "shm falut"
+    producer.close()
+    channel.unlink()
+
+def test_candidates():
+    table = parse.regtable({"37": 0, "115": 1, "2": 2})
+    rcols, vcols, (reward, mask) = parse.candidates([[37, 5], [99, 7], [2, 1]], [[115, 3]], table, 3)
+    if list(rcols) != [0, 2] or list(vcols) != [1]:
+        print "falut"
+    if list(reward) != [5, 3, 1] or not mask.all():
+        print "falut"
+    if list(parse.lookup(table, [115, 1000, -1, 3])) != [1, -1, -1, -1]:
+        print "falut"
+
+def test_profile():
+    cachedir = "testprofile"
+    f = open("testprofile.ll", "w")
+    f.write("define void @f() {\n  ret void\n}\n")
+    f.close()
+    key = regprofile.profilekey("testprofile.ll", "testprofile.ll", ["--regalloc=drl"])
+    regprofile.invalidate(cachedir)
+    if regprofile.loadprofile(cachedir, key) is not None:
+        print "falut"
+    regprofile.saveprofile(cachedir, key, set(["37", "115"]), 300)
+    if regprofile.loadprofile(cachedir, key) != (set(["37", "115"]), 300):
+        print "falut"
+    if regprofile.profilekey("testprofile.ll", "testprofile.ll", ["--regalloc=greedy"]) == key:
+        print "falut"
+    regprofile.invalidate(cachedir, key)
+    if regprofile.loadprofile(cachedir, key) is not None:
+        print "falut"
+    os.remove("testprofile.ll")
+    os.rmdir(cachedir)
+
 def main():
     a = normal()
     test_normal(a)
@@ -265,6 +353,11 @@ def main():
     test_physical_up(e)
     f = virtualoverlapoccupy()
     test_virtual_overlap(f)
+    test_occupy()
+    test_incremental()
+    test_shm()
+    test_candidates()
+    test_profile()
 
 
 
@@ -0,0 +1,183 @@
+"""
+
+Wall time per phase of a training iteration. A phase is timed with
+
+    with timing.phase("Act"):
+        ...
+
+or by decorating a function with @timing.phase("Parse"). Totals and call
+counts accumulate per thread until collect hands them over or log writes
+them to the tabular log, and start over. A thread sampling rollouts while
+another one updates collects at the end of its batch and the updating
+thread merges the result, so every phase lands on the row of its own
+iteration. Every phase of PHASES is logged on every row, logz wants the
+same keys each iteration.
+
+    Compiler  llc and the socket or ring waits, from an action to the next state
+    Parse     decoding and rasterizing states
+    Act       forward passes of the policy
+    Among     choosing among the candidate registers
+    Returns   returns and advantages
+    Update    policy and baseline updates
+
+With instrument() every timed call of a stage of the decision loop also
+lands in a fixed size log scale histogram, STEPS buckets per doubling from
+1us, and its p50/p95/p99 are logged. Between starttrace and stoptrace every
+timed call is also kept as an event of a Chrome trace (chrome://tracing).
+
+    Accept  accepting the compiler connection
+    Recv    waiting for and reading a state
+    Parse   decoding and rasterizing it
+    Act     the forward pass
+    Among   choosing the register
+    Send    sending the action
+
+"""
+
+import os
+import json
+import math
+import time
+import threading
+import functools
+
+PHASES = ("Compiler", "Parse", "Act", "Among", "Returns", "Update")
+STAGES = ("Accept", "Recv", "Parse", "Act", "Among", "Send")
+PERCENTILES = (50, 95, 99)
+
+STEPS = 8
+BUCKETS = 32 * STEPS
+BASE = 1e-6
+
+instrumented = False
+events = None
+# the trace is shared by every thread
+tracelock = threading.Lock()
+local = threading.local()
+
+
+def own():
+    """
+    The totals, counts and histograms of the calling thread
+    """
+    if not hasattr(local, "totals"):
+        local.totals = {}
+        local.counts = {}
+        local.histograms = {}
+    return local
+
+def add(name, seconds, begin=None):
+    mine = own()
+    mine.totals[name] = mine.totals.get(name, 0.0) + seconds
+    mine.counts[name] = mine.counts.get(name, 0) + 1
+    if instrumented:
+        hist = mine.histograms.get(name)
+        if hist is None:
+            hist = mine.histograms[name] = [0] * BUCKETS
+        hist[bucket(seconds)] += 1
+    if events is not None and begin is not None:
+        with tracelock:
+            if events is not None:
+                events.append((name, begin, seconds, threading.current_thread().ident))
+
+def merge(phasetotals, phasecounts, phasehistograms=None):
+    """
+    Add what collect returned in another process or thread
+    """
+    mine = own()
+    for name in phasetotals:
+        mine.totals[name] = mine.totals.get(name, 0.0) + phasetotals[name]
+        mine.counts[name] = mine.counts.get(name, 0) + phasecounts[name]
+    if instrumented and phasehistograms:
+        for name, hist in phasehistograms.items():
+            target = mine.histograms.setdefault(name, [0] * BUCKETS)
+            for i, n in enumerate(hist):
+                target[i] += n
+
+def instrument(enable=True):
+    global instrumented
+    instrumented = enable
+
+def bucket(seconds):
+    if seconds <= BASE:
+        return 0
+    return min(int(math.log(seconds / BASE, 2) * STEPS) + 1, BUCKETS - 1)
+
+def percentile(hist, q):
+    """
+    Upper bound in seconds of the bucket holding the q-th percentile
+    """
+    total = sum(hist)
+    if total == 0:
+        return 0.0
+    seen = 0
+    for i, n in enumerate(hist):
+        seen += n
+        if seen * 100.0 >= total * q:
+            return BASE * 2 ** (i / float(STEPS))
+    return BASE * 2 ** (BUCKETS / float(STEPS))
+
+def starttrace():
+    global events
+    with tracelock:
+        events = []
+
+def tracing():
+    return events is not None
+
+def stoptrace(path):
+    global events
+    with tracelock:
+        done, events = events, None
+    trace = [{"name": name, "ph": "X", "ts": begin * 1e6, "dur": seconds * 1e6, "pid": os.getpid(), "tid": tid}
+             for name, begin, seconds, tid in done]
+    with open(path, "w") as out:
+        out.write(json.dumps({"traceEvents": trace, "displayTimeUnit": "ms"}))
+
+class phase:
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._begin = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        add(self._name, time.time() - self._begin, self._begin)
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with phase(self._name):
+                return fn(*args, **kwargs)
+        return timed
+
+def collect():
+    """
+    Returns the (totals, counts, histograms) of the calling thread so far
+    and starts over, histograms is None without instrument
+    """
+    mine = own()
+    res = (mine.totals, mine.counts, mine.histograms if instrumented else None)
+    mine.totals = {}
+    mine.counts = {}
+    mine.histograms = {}
+    return res
+
+def log(logz, steps, elapsed):
+    """
+    Per phase total and mean per step for the steps of an iteration that
+    were sampled in elapsed seconds, and the steps per second
+    """
+    phasetotals, _, phasehistograms = collect()
+    steps = max(steps, 1)
+    for name in PHASES:
+        logz.log_tabular("Time" + name, phasetotals.get(name, 0.0))
+        logz.log_tabular(name + "PerStep", phasetotals.get(name, 0.0) / steps)
+    logz.log_tabular("StepsPerSecond", steps / max(elapsed, 1e-9))
+    if phasehistograms is not None:
+        for name in STAGES:
+            hist = phasehistograms.get(name, [0])
+            for q in PERCENTILES:
+                logz.log_tabular("%sP%d" % (name, q), percentile(hist, q))
@@ -1,15 +1,17 @@
 import numpy as np
 import logz
-import tensorflow as tf
 import environment as en 
-import scipy.signal
 import os
+import json
 import time
 import inspect
 from multiprocessing import Process
-import gym
-import function as func 
 import policy_gradient
+import regprofile
+import outcome
+import timing
+import dataset
+import corpus
 
 
 #============================================================================================#
@@ -39,7 +41,31 @@ def train_PG(
              # network arguments
              n_layers=1,
              size=32,
-             tofile=False,
+             trajmode="off",
+             binary=False,
+             persistent=False,
+             n_envs=1,
+             max_batch=None,
+             max_wait=0.0,
+             record=None,
+             incremental=False,
+             checkstate=False,
+             sharedmem=False,
+             outcome_cache=None,
+             eval_episodes=0,
+             gae_lambda=None,
+             baseline_lr=1e-4,
+             backend_options=None,
+             checkpoint_every=1,
+             keep_checkpoints=None,
+             latency_histograms=False,
+             trace_every=0,
+             overlap=False,
+             max_lag=1,
+             programs=None,
+             schedule="recency",
+             port=en.PORT,
+             rundir=None,
              ):
 
     start = time.time()
@@ -56,10 +82,28 @@ def train_PG(
     # Set random seeds
     np.random.seed(seed)
 
+    # before the VecGplayer workers are forked, they histogram their stages too
+    timing.instrument(latency_histograms)
+
+    # everything the players write goes under rundir, with the ports from
+    # port on, so that runs share a machine
+    root = rundir or "./data"
+    log_dir = os.path.join(root, "log/")
+    workdir = os.path.join(root, "work") if rundir else None
+
     # Make the gym environment
     #env = gym.make(env_name)
-    env = en.Gplayer(idx2regs, regs2idx, maxlength, tofile, "./data/log/")
-    act = func.ActorFunc()
+    if programs:
+        # the workers take the programs of the corpus by turns of schedule
+        scheduler = corpus.Scheduler(programs, schedule, seed)
+        env = corpus.CorpusPlayer(scheduler, n_envs, trajmode, log_dir, os.path.join(logdir, "programs.json"), binary=binary, persistent=persistent, port=port, workdir=os.path.join(root, "worker"), incremental=incremental, checkstate=checkstate, sharedmem=sharedmem, trace_every=trace_every)
+    elif n_envs > 1:
+        env = en.VecGplayer(n_envs, idx2regs, regs2idx, maxlength, trajmode, log_dir, binary, persistent, port=port, workdir=os.path.join(root, "worker"), incremental=incremental, checkstate=checkstate, sharedmem=sharedmem, trace_every=trace_every)
+    else:
+        env = en.Gplayer(idx2regs, regs2idx, maxlength, trajmode, log_dir, binary, persistent, port=port, workdir=workdir, incremental=incremental, checkstate=checkstate, sharedmem=sharedmem, trace_every=trace_every)
+    # TensorFlow is loaded only now, the VecGplayer workers are forked without it
+    import function as func
+    act = func.ActorFunc(seed=seed, **(backend_options or {}))
     
     # Is this env continuous, or discrete?
     discrete = True
@@ -78,13 +122,88 @@ def train_PG(
 
     act.createPred(ac_dim, n_layers, size)
     act.createOptimizer(learning_rate)
+    if nn_baseline:
+        act.createBaseline(baseline_lr)
+    if overlap:
+        # rollouts act with a copy of the policy while update trains it
+        act.createSnapshot()
     act.run_init()
     #========================================================================================#
     # Training Loop
     #========================================================================================#
-    pg = policy_gradient.PolicyGradient(n_iter, env, act, animate, min_timesteps_per_batch, max_path_length, reward_to_go)
+    recorder = dataset.DatasetWriter(record, actionsize) if record else None
+    import checkpoint
+    checkpointer = checkpoint.Checkpointer(logz.G.output_dir, checkpoint_every, keep_checkpoints)
+    pg = policy_gradient.PolicyGradient(n_iter, env, act, animate, min_timesteps_per_batch, max_path_length, reward_to_go, max_batch, max_wait, recorder, normalize_advantages, nn_baseline, gae_lambda, checkpointer, overlap, max_lag)
 
     pg.run(gamma, logz, start)
+    checkpointer.close()
+    if n_envs > 1 or programs:
+        # the workers hold port, evaluation runs in this process
+        env.close()
+    if eval_episodes:
+        # greedy rollouts on one player, answered by the outcome cache when
+        # there is one, training episodes never go into the cache. A corpus
+        # is evaluated on its first program.
+        evalenv = env
+        if outcome_cache:
+            cache = outcome.OutcomeCache(outcome_cache)
+            evalenv = en.CachedGplayer(cache, idx2regs, regs2idx, maxlength, "off", log_dir, binary=binary, persistent=persistent, port=port, workdir=workdir, incremental=incremental, checkstate=checkstate, sharedmem=sharedmem)
+        elif n_envs > 1 or programs:
+            evalenv = en.Gplayer(idx2regs, regs2idx, maxlength, "off", log_dir, binary, persistent, port=port, workdir=workdir, incremental=incremental, checkstate=checkstate, sharedmem=sharedmem)
+        if programs:
+            evalenv.usesource(programs[0].src)
+        res = pg.evaluate(eval_episodes, evalenv)
+        with open(os.path.join(logdir, "eval.json"), "w") as out:
+            out.write(json.dumps(res, sort_keys=True))
+
+#============================================================================================#
+# Policy Gradient on a recorded dataset, no compiler involved
+#============================================================================================#
+
+def replay_PG(
+             datadir,
+             exp_name,
+             n_iter=100,
+             gamma=1.0,
+             batch_size=1000,
+             learning_rate=0.000000625,
+             reward_to_go=True,
+             logdir=None,
+             seed=0,
+             n_layers=1,
+             size=32,
+             backend_options=None,
+             ):
+
+    start = time.time()
+    logz.configure_output_dir(logdir)
+    args = inspect.getargspec(replay_PG)[0]
+    locals_ = locals()
+    params = {k: locals_[k] if k in locals_ else None for k in args}
+    logz.save_params(params)
+    np.random.seed(seed)
+
+    data = dataset.Dataset(datadir)
+    import function as func
+    act = func.ActorFunc(seed=seed, **(backend_options or {}))
+    act.createPred(data.actionsize, n_layers, size)
+    act.createOptimizer(learning_rate)
+    act.run_init()
+
+    # one iteration is one pass over the dataset
+    for itr in range(n_iter):
+        begin = time.time()
+        losses = []
+        for ob_no, ac_na, q_n, mask_na in data.minibatches(batch_size, gamma, reward_to_go):
+            _, loss_value = act.update(ob_no, ac_na, q_n, mask_na)
+            losses.append(loss_value)
+        logz.log_tabular("Time", time.time() - start)
+        logz.log_tabular("Iteration", itr)
+        logz.log_tabular("Loss", np.mean(losses))
+        logz.log_tabular("Steps", len(data))
+        logz.log_tabular("StepsPerSecond", len(data) / (time.time() - begin))
+        logz.dump_tabular()
 
 def gen(actionset):
     idx2regs = [a for a in actionset]
@@ -108,25 +227,96 @@ def main():
     parser.add_argument('--reward_to_go', '-rtg', action='store_true')
     parser.add_argument('--dont_normalize_advantages', '-dna', action='store_true')
     parser.add_argument('--nn_baseline', '-bl', action='store_true')
+    parser.add_argument('--gae_lambda', type=float, default=None)
+    parser.add_argument('--baseline_lr', type=float, default=1e-4)
     parser.add_argument('--seed', type=int, default=1)
     parser.add_argument('--n_experiments', '-e', type=int, default=1)
     parser.add_argument('--n_layers', '-l', type=int, default=2)
     parser.add_argument('--size', '-s', type=int, default=128)
+    parser.add_argument('--binary', action='store_true')
+    parser.add_argument('--persistent', action='store_true')
+    parser.add_argument('--n_envs', type=int, default=1)
+    parser.add_argument('--trajectory', type=str, default='off', choices=['off', 'sampled', 'full'])
+    parser.add_argument('--record', type=str, default=None)
+    parser.add_argument('--replay', type=str, default=None)
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--checkstate', action='store_true')
+    parser.add_argument('--sharedmem', action='store_true')
+    parser.add_argument('--max_batch', type=int, default=None)
+    parser.add_argument('--max_wait', type=float, default=0.0)
+    parser.add_argument('--gpu', type=str, default=None)
+    parser.add_argument('--act_threads', type=int, default=1)
+    parser.add_argument('--update_threads', type=int, default=1)
+    parser.add_argument('--intra_threads', type=int, default=1)
+    parser.add_argument('--cpus', type=str, default=None)
+    parser.add_argument('--checkpoint_every', type=int, default=1)
+    parser.add_argument('--keep_checkpoints', type=int, default=None)
+    parser.add_argument('--latency_histograms', action='store_true')
+    parser.add_argument('--trace_every', type=int, default=0)
+    parser.add_argument('--overlap', action='store_true')
+    parser.add_argument('--max_lag', type=int, default=1)
+    parser.add_argument('--corpus', type=str, default=None)
+    parser.add_argument('--schedule', type=str, default="recency", choices=corpus.POLICIES)
+    parser.add_argument('--profile_cache', type=str, default=regprofile.CACHEDIR)
+    parser.add_argument('--invalidate_profile', action='store_true')
+    parser.add_argument('--outcome_cache', action='store_true')
+    parser.add_argument('--eval_episodes', type=int, default=0)
+    parser.add_argument('--port', type=int, default=en.PORT)
+    parser.add_argument('--rundir', type=str, default=None)
     args = parser.parse_args()
+    # set before the first TensorFlow import, in train_PG or replay_PG
+    if args.gpu is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    backend_options = {"act_threads": args.act_threads, "update_threads": args.update_threads,
+                       "intra_threads": args.intra_threads, "cpus": args.cpus}
 
-    if not(os.path.exists('data')):
-        os.makedirs('data')
+    # a run of experiments.py has a directory of its own instead of data
+    root = args.rundir or 'data'
+    workdir = os.path.join(root, 'work') if args.rundir else None
+    for d in (root, os.path.join(root, 'log'), workdir):
+        if d and not(os.path.exists(d)):
+            os.makedirs(d)
     logdir = args.exp_name + '_' + args.env_name + '_' + time.strftime("%d-%m-%Y_%H-%M-%S")
-    logdir = os.path.join('data', logdir)
+    logdir = os.path.join(root, logdir)
     if not(os.path.exists(logdir)):
         os.makedirs(logdir)
 
     max_path_length = args.ep_len if args.ep_len > 0 else None
-    rplayer = en.RandomPlayer("./data/log/")
-    rplayer.reset()
-    actionset, maxlength = rplayer.step()
-    idx2regs, regs2idx = gen(actionset)
-    name = "./data/log/register maping.txt"
+    if args.replay:
+        for e in range(args.n_experiments):
+            seed = args.seed + 10*e
+            print('Replaying %s with seed %d'%(args.replay, seed))
+            replay_PG(
+                args.replay,
+                exp_name=args.exp_name,
+                n_iter=args.n_iter,
+                gamma=args.discount,
+                batch_size=args.batch_size,
+                learning_rate=args.learning_rate,
+                reward_to_go=args.reward_to_go,
+                logdir=os.path.join(logdir,'%d'%seed),
+                seed=seed,
+                n_layers=args.n_layers,
+                size=args.size,
+                backend_options=backend_options
+                )
+        return
+    programs = None
+    if args.corpus:
+        programs = corpus.profile(corpus.loadcorpus(args.corpus), corpus.ACTIONSIZE, os.path.join(root, "log/"), args.binary, args.persistent, args.profile_cache, args.invalidate_profile, args.port, workdir)
+        # the action set of the policy, every program maps its own registers
+        # on its first indices
+        idx2regs, regs2idx, maxlength = programs[0].idx2regs, programs[0].regs2idx, programs[0].maxlength
+    # a corpus is evaluated, and its outcomes cached, on the first program
+    rplayer = en.RandomPlayer(os.path.join(root, "log/"), args.binary, args.persistent, args.port, workdir, programs[0].src if programs else None)
+    if programs is None:
+        actionset, maxlength = regprofile.discover(rplayer, args.profile_cache, args.invalidate_profile)
+        idx2regs, regs2idx = gen(actionset)
+    # episodes are cached per compiler, source and flags, like the profile
+    cachepath = None
+    if args.outcome_cache:
+        cachepath = os.path.join(root, "outcome", regprofile.playerkey(rplayer) + ".pkl")
+    name = os.path.join(root, "log", "register maping.txt")
     f = open(name, "w")
     f.write(str(regs2idx))
     f.close()
@@ -157,7 +347,31 @@ def main():
                 seed=seed,
                 n_layers=args.n_layers,
                 size=args.size,
-                tofile=False
+                trajmode=args.trajectory,
+                binary=args.binary,
+                persistent=args.persistent,
+                n_envs=args.n_envs,
+                max_batch=args.max_batch,
+                max_wait=args.max_wait,
+                record=args.record,
+                incremental=args.incremental,
+                checkstate=args.checkstate,
+                sharedmem=args.sharedmem,
+                outcome_cache=cachepath,
+                eval_episodes=args.eval_episodes,
+                gae_lambda=args.gae_lambda,
+                baseline_lr=args.baseline_lr,
+                backend_options=backend_options,
+                checkpoint_every=args.checkpoint_every,
+                keep_checkpoints=args.keep_checkpoints,
+                latency_histograms=args.latency_histograms,
+                trace_every=args.trace_every,
+                overlap=args.overlap,
+                max_lag=args.max_lag,
+                programs=programs,
+                schedule=args.schedule,
+                port=args.port,
+                rundir=args.rundir
                 )
         # Awkward hacky process runs, because Tensorflow does not like
         # repeatedly calling train_PG in the same thread.
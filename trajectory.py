@@ -0,0 +1,145 @@
+"""
+
+Append-only trajectory records, one file per recorded episode, written by a
+background thread so that no file is touched on the decision path.
+
+    off:      nothing is recorded
+    sampled:  every `every`-th episode is recorded
+    full:     every episode is recorded
+
+A record is a (kind, iteration, payload length) header (!BiI) followed by
+its payload. States are kept as the compiler sent them, the text of
+state.txt or the payload of a binary state or delta frame, actions as the physical
+register (!i) and rewards as (!d). The queue between the decision path and
+the writer is bounded. When a record does not fit, the rest of its episode
+is not recorded and dropped counts it, so a file only ever holds records of
+one episode, and an episode whose open does not fit has no file at all.
+
+"""
+
+import os
+import struct
+import threading
+import atexit
+import Queue
+import protocol
+
+OFF = "off"
+SAMPLED = "sampled"
+FULL = "full"
+MODES = (OFF, SAMPLED, FULL)
+
+TEXTSTATE = 1
+FRAMESTATE = 2
+ACTION = 3
+REWARD = 4
+DELTASTATE = 5
+
+RECORD = struct.Struct("!BiI")
+ACTIONBODY = struct.Struct("!i")
+REWARDBODY = struct.Struct("!d")
+
+
+class TrajectoryLog:
+    def __init__(self, log_dir, mode=OFF, every=10, maxqueue=4096):
+        assert mode in MODES, "Unknown trajectory mode %s" % mode
+        self._log_dir = log_dir
+        self._mode = mode
+        self._every = every
+        self._episode = 0
+        self._recording = False
+        self.dropped = 0
+        if mode == OFF:
+            return
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        self._queue = Queue.Queue(maxqueue)
+        self._writer = threading.Thread(target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+        atexit.register(self.close)
+
+    def begin(self):
+        """
+        Start a new episode, returns whether it is recorded
+        """
+        self._episode += 1
+        self._recording = self._mode == FULL or (self._mode == SAMPLED and self._episode % self._every == 1 % self._every)
+        if self._recording:
+            self._put("open", os.path.join(self._log_dir, "episode%d.traj" % self._episode))
+        return self._recording
+
+    def recording(self):
+        return self._recording
+
+    def state(self, iteration, data, frame=None):
+        """
+        frame is the protocol kind of a binary frame, None for state.txt
+        """
+        if self._recording:
+            kind = {None: TEXTSTATE, protocol.STATE: FRAMESTATE, protocol.DELTA: DELTASTATE}[frame]
+            self._put("record", RECORD.pack(kind, iteration, len(data)) + str(data))
+
+    def action(self, iteration, reg):
+        if self._recording:
+            self._put("record", RECORD.pack(ACTION, iteration, ACTIONBODY.size) + ACTIONBODY.pack(int(reg)))
+
+    def reward(self, iteration, reward):
+        if self._recording:
+            self._put("record", RECORD.pack(REWARD, iteration, REWARDBODY.size) + REWARDBODY.pack(reward))
+
+    def end(self):
+        if self._recording:
+            self._put("close", None)
+        self._recording = False
+
+    def close(self):
+        if self._mode == OFF or not self._writer.is_alive():
+            return
+        self.end()
+        self._queue.put(("stop", None))
+        self._writer.join()
+
+    def _put(self, op, data):
+        try:
+            self._queue.put_nowait((op, data))
+        except Queue.Full:
+            # the writer would put the next records in the wrong file, the
+            # episode is not recorded from here on
+            self.dropped += 1
+            self._recording = False
+
+    def _write(self):
+        f = None
+        while True:
+            op, data = self._queue.get()
+            if op == "record":
+                if f is not None:
+                    f.write(data)
+                continue
+            if f is not None:
+                f.close()
+                f = None
+            if op == "open":
+                # episode numbers start over in every process
+                f = open(data, "wb")
+            elif op == "stop":
+                break
+
+def readtrajectory(name):
+    """
+    Yield the (kind, iteration, value) records of a trajectory file
+    """
+    data = open(name, "rb").read()
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        kind, iteration, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        payload = data[offset:offset + length]
+        offset += length
+        if kind == ACTION:
+            yield kind, iteration, ACTIONBODY.unpack(payload)[0]
+        elif kind == REWARD:
+            yield kind, iteration, REWARDBODY.unpack(payload)[0]
+        else:
+            yield kind, iteration, payload